@@ -0,0 +1,72 @@
+"""Parse cost of the big GBFS feeds, strict pydantic validation against the fast records
+
+Payloads are generated, sized like a large dockless system by default:
+
+    python -m gbfs.bench
+    python -m gbfs.bench --stations 500 --bikes 2000 --repeat 20
+"""
+import argparse
+import json
+import random
+import time
+
+from gbfs.records import loads, parse_feed
+
+
+def make_payloads(stations: int, bikes: int) -> dict:
+    """Encoded station_information, station_status and free_bike_status shaped like bluebikes'"""
+    random.seed(1)
+    now = int(time.time())
+    feed = lambda data: json.dumps({"last_updated": now, "ttl": 10, "data": data}).encode()
+    information = [{
+        "station_id": f"{i}", "name": f"Station {i}", "short_name": f"S{32000 + i}",
+        "lat": 42.3 + random.random() * .1, "lon": -71.1 + random.random() * .1,
+        "rental_methods": ["KEY", "CREDITCARD"], "capacity": 19, "region_id": "10", "legacy_id": f"{i}",
+        "eightd_station_services": [], "eightd_has_key_dispenser": False, "station_type": "classic",
+        "electric_bike_surcharge_waiver": False, "has_kiosk": True, "external_id": f"x{i}",
+        "rental_uris": {"android": "https://example.com/a", "ios": "https://example.com/i"},
+    } for i in range(stations)]
+    status = []
+    for i in range(stations):
+        available = random.randint(0, 19)
+        status.append({
+            "station_id": f"{i}", "num_bikes_available": available,
+            "num_ebikes_available": random.randint(0, available), "num_bikes_disabled": 0,
+            "num_docks_available": 19 - available, "num_docks_disabled": 0, "is_installed": 1, "is_renting": 1,
+            "is_returning": 1, "last_reported": now - random.randint(0, 300), "eightd_has_available_keys": False,
+            "station_status": "active",
+        })
+    free_bikes = [{
+        "bike_id": f"b{i}", "lat": 42.3 + random.random() * .1, "lon": -71.1 + random.random() * .1,
+        "is_reserved": 0, "is_disabled": 0, "rental_uris": {}, "vehicle_type_id": "ebike", "last_reported": now,
+    } for i in range(bikes)]
+    return {
+        "station_information": feed({"stations": information}),
+        "station_status": feed({"stations": status}),
+        "free_bike_status": feed({"bikes": free_bikes}),
+    }
+
+
+def time_parse(name: str, body: bytes, strict: bool, repeat: int) -> float:
+    """Best of repeat, decode included, in ms"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse_feed(name, loads(body), strict)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, default=2000)
+    parser.add_argument("--bikes", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, body in make_payloads(args.stations, args.bikes).items():
+        strict = time_parse(name, body, True, args.repeat)
+        fast = time_parse(name, body, False, args.repeat)
+        print(f"{name:<20} {len(body) / 1024:8.0f}KiB  strict {strict:8.1f}ms  fast {fast:7.1f}ms  "
+              f"{strict / fast:5.1f}x")
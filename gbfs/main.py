@@ -1,22 +1,40 @@
-from typing import Dict, Union, List, Optional
+import time
+from typing import Any, Callable, Dict, Union, List, Optional, Set, Tuple
 
 from autobahn import wamp
 from autobahn.twisted import ApplicationSession
 from autobahn.twisted.component import Component
 from autobahn.twisted.component import run
-from pydantic import BaseModel, Field
-from twisted.internet.defer import inlineCallbacks
+from autobahn.wamp import PublishOptions
+from pydantic import BaseModel, Field, PrivateAttr
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, DeferredSemaphore, TimeoutError, inlineCallbacks
 from twisted.internet.task import LoopingCall
 from twisted.web._newclient import Response
 
-from compat import LAMachineCompatMixin, CompatConfig, Machine
+from compat import LAMachineCompatMixin, CompatConfig, Machine, SRC_PREFIX
 from config import NAMESPACE_PREFIX
-from gbfs.models import GBFSIndex, GBFSSystemInformation, feed_to_parser, GBFSStationInformation, GBFSStationStatus, \
-    GBFSFreeBikeStatus, GBFSSystemHours, GBFSSystemCalendar, GBFSSystemRegion, GBFSSystemAlerts, GBFSFeedName
+from gbfs.models import GBFSIndex, GBFSIndexFeed, GBFSSystemInformation, GBFSStationInformation, GBFSStationStatus, \
+    GBFSFreeBikeStatus, GBFSJoinedStation, GBFSStationStatusStation, GBFSSystemHours, GBFSSystemCalendar, GBFSSystemRegion, GBFSSystemAlerts, GBFSFeedName
+from gbfs.records import loads, parse_feed
+from gbfs.render import FrameRenderer
+from gbfs.scheduler import FeedKey, FeedScheduler, next_fetch
+from spatial import GridIndex
 
 ns = "LA4-DATA-GBFS"
 GBFS_PREFIX = NAMESPACE_PREFIX + "gbfs."
 
+INDEX_FEED = "gbfs"  # the gbfs.json index itself, scheduled like any other feed
+STATUS_FEEDS = {GBFSFeedName.STATION_STATUS.value, GBFSFeedName.FREE_BIKE_STATUS.value}
+
+
+def _coords(entity) -> Optional[Tuple[float, float]]:
+    """lat/lon as floats, validated feeds keep them as strings and free bikes may not have any"""
+    try:
+        return float(entity.lat), float(entity.lon)
+    except (TypeError, ValueError):
+        return None
+
 
 class GBFSConfig(BaseModel):
     id: str  # bluebikes
@@ -27,12 +45,14 @@ class GBFSConfig(BaseModel):
 
     gbfs_ttl_data_days: int = 1
     gbfs_ttl_stations_seconds: int = 300
+    strict: bool = False  # validate every feed with the pydantic models instead of the fast records
 
 
 class GBFSResult(BaseModel):
     config: GBFSConfig
     index: GBFSIndex
     system_information: Optional[GBFSSystemInformation]
+    # set_feed stores the gbfs.records equivalents of these three unless the config is strict
     station_information: Optional[GBFSStationInformation]
     station_status: Optional[GBFSStationStatus]
     free_bike_status: Optional[GBFSFreeBikeStatus]
@@ -41,8 +61,106 @@ class GBFSResult(BaseModel):
     system_regions: Optional[GBFSSystemRegion]
     system_alerts: Optional[GBFSSystemAlerts]
 
+    # station_id and short_name -> information joined with status, rebuilt whenever either feed is replaced
+    _stations: Dict[str, GBFSJoinedStation] = PrivateAttr(default_factory=dict)
+    # station_id / bike_id -> location, moved in place as the feeds are refreshed
+    _station_grid: GridIndex = PrivateAttr(default_factory=GridIndex)
+    _bike_grid: GridIndex = PrivateAttr(default_factory=GridIndex)
+    _bikes: Dict[str, Any] = PrivateAttr(default_factory=dict)
+
+    def set_feed(self, name: str, feed: BaseModel) -> Dict[str, Optional[GBFSStationStatusStation]]:
+        """Store a freshly fetched feed, returning station_id -> status for the stations that changed
+
+        station_status is merged into the previous payload, only stations that reported since are replaced. Stations
+        missing from it are returned with a None status.
+        """
+        if name == GBFSFeedName.STATION_STATUS.value and self.station_status is not None:
+            changed, dropped = self.station_status.merge(feed)
+            changed = {i.station_id: i for i in changed}
+            changed.update(dict.fromkeys(dropped))
+            for station_id, status in changed.items():
+                joined = self._stations.get(station_id)
+                if joined:
+                    joined = joined._replace(status=status)
+                    self._stations[joined.information.short_name] = joined
+                    self._stations[joined.information.station_id] = joined
+            return changed
+
+        setattr(self, name, feed)
+        if name in (GBFSFeedName.STATION_INFORMATION.value, GBFSFeedName.STATION_STATUS.value):
+            self.build_station_index()
+        if name == GBFSFeedName.STATION_INFORMATION.value:
+            self._locate(self._station_grid, {i.station_id: i for i in feed.data.stations})
+        if name == GBFSFeedName.FREE_BIKE_STATUS.value:
+            self._bikes = {i.bike_id: i for i in feed.data.bikes}
+            self._locate(self._bike_grid, self._bikes)
+        if name == GBFSFeedName.STATION_STATUS.value:
+            return {i.station_id: i for i in feed.data.stations}
+        return {}
+
+    def build_station_index(self):
+        self._stations = {}
+        if not self.station_information:
+            return
+        for info in self.station_information.data.stations:
+            joined = GBFSJoinedStation(
+                information=info,
+                status=self.station_status.by_id(info.station_id) if self.station_status else None,
+            )
+            self._stations[info.short_name] = joined
+            self._stations[info.station_id] = joined
+
+    def station(self, station_id: str) -> Optional[GBFSJoinedStation]:
+        """Information and status of a station by short_name or station_id in one lookup"""
+        return self._stations.get(station_id)
+
+    @staticmethod
+    def _locate(grid: GridIndex, entities: Dict[str, Any]):
+        """Move the grid's points to where entities are now, dropping the ones that are gone or lost their location"""
+        for key, entity in entities.items():
+            coords = _coords(entity)
+            if coords:
+                grid.insert(key, *coords)
+            else:
+                grid.remove(key)
+        for key in [i for i in grid.points if i not in entities]:
+            grid.remove(key)
+
+    def _renting(self, station_id: str, min_bikes: int = 0) -> bool:
+        joined = self._stations.get(station_id)
+        return bool(joined and joined.status and joined.status.is_renting
+                    and (joined.status.num_bikes_available or 0) >= min_bikes)
+
+    def neighbourhood(self, lat: float, lon: float, radius_m: float) -> Dict[str, Any]:
+        """Bikes and docks available within radius_m, over renting stations and the free bikes not at a station"""
+        stations = [self._stations[i] for _, i in self._station_grid.within(lat, lon, radius_m, self._renting)]
+        free_bikes = [self._bikes[i] for _, i in self._bike_grid.within(lat, lon, radius_m)]
+        free_bikes = [i for i in free_bikes if not (i.is_reserved or i.is_disabled or i.station_id)]
+        return {
+            "station_ids": [i.information.station_id for i in stations],
+            "num_bikes_available": sum(i.status.num_bikes_available or 0 for i in stations) + len(free_bikes),
+            "num_ebikes_available": sum(i.status.num_ebikes_available or 0 for i in stations),
+            "num_docks_available": sum(i.status.num_docks_available or 0 for i in stations),
+            "num_free_bikes_available": len(free_bikes),
+        }
+
+    def nearest_stations(self, lat: float, lon: float, k: int, min_bikes: int = 1,
+                         max_m: Optional[float] = None) -> List[Tuple[float, GBFSJoinedStation]]:
+        """The k nearest renting stations with at least min_bikes available, nearest first"""
+        found = self._station_grid.nearest(lat, lon, k, max_m, lambda i: self._renting(i, min_bikes))
+        return [(distance, self._stations[i]) for distance, i in found]
+
     def _nice_names(self, station_id):
-        return "".join(self.station_information.by_id(station_id).name.split(' ')[0:2])
+        station = self.station(station_id)
+        if not station:
+            return station_id
+        return "".join(station.information.name.split(' ')[0:2])
+
+    def machine_id(self, station_id: str, smear: Optional[int] = None) -> str:
+        """The machine a station's frames are published as, smear is given when there are several"""
+        if smear is None:
+            return f"{ns}-{self.config.id}-{station_id}".lower()
+        return f"{ns}-{self.config.id}-{station_id}-F-S{smear}".lower()
 
     def complex_machines(self, cconfig: CompatConfig) -> Dict[str, Machine]:
         if not self.station_information:
@@ -52,7 +170,7 @@ class GBFSResult(BaseModel):
             return {id: Machine(
                 name=ns,
                 iname=f"{self.config.name}-{self._nice_names(id)}-F",
-                id=f"{ns}-{self.config.id}-{id}".lower(),
+                id=self.machine_id(id),
                 desc=f"Bike Count for Station {id} (fill)",
                 speed=cconfig.speed_enum.name
             ) for id in self.config.stations}
@@ -62,7 +180,7 @@ class GBFSResult(BaseModel):
                 ret.update(**{f"{id}-{smear}": Machine(
                     name=ns,
                     iname=f"{self.config.name}-{self._nice_names(id)}-F-S{smear}",
-                    id=f"{ns}-{self.config.id}-{id}-F-S{smear}".lower(),
+                    id=self.machine_id(id, smear),
                     desc=f"Bike Count for Station {id} (fill-smear-{smear})",
                     speed=cconfig.speed_enum.name
                 ) for id in self.config.stations})
@@ -86,32 +204,149 @@ class GBFSSession(LAMachineCompatMixin, ApplicationSession):
     }
     results: Union[Dict[str, GBFSResult], Dict[str, List[GBFSResult]]] = {}
 
+    fetch_concurrency: int = 4  # metadata requests in flight at once, across all systems
+    status_fetch_concurrency: int = 8  # same for the status lane, which never waits on metadata
+    fetch_timeout_seconds: float = 30
+    fetch_semaphores: Dict[bool, DeferredSemaphore] = {}  # status lane or not -> semaphore
+
+    scheduler = FeedScheduler()  # metadata feeds and the index
+    status_scheduler = FeedScheduler()  # station_status and free_bike_status
+    fetching: Set[FeedKey] = set()  # popped from a scheduler, rescheduled once their fetch is done
+    status_latency: Dict[str, float] = {}  # config_id -> seconds the last status refresh took
+    # called with (config_id, station_id, status) for every station that reported since the previous poll, the
+    # status is None when the station is gone from station_status
+    station_listeners: List[Callable[[str, str, Optional[GBFSStationStatusStation]], None]] = []
+    renderer = FrameRenderer(cconfig.smears)
+    min_status_seconds: float = 5  # floors on the advertised ttls
+    min_metadata_seconds: float = 300
+    retry_seconds: float = 60
+
     @wamp.register(GBFS_PREFIX + "register")
     def register_config(self):
         pass
 
     @wamp.register(GBFS_PREFIX + "remove")
-    def remove_config(self):
-        pass
+    def remove_config(self, config_id: str) -> bool:
+        """Stop polling a config and free its results, fetches still in flight are dropped as they land"""
+        if self.configs.pop(config_id, None) is None:
+            return False
+        self.results.pop(config_id, None)
+        self.scheduler.remove_config(config_id)
+        self.status_scheduler.remove_config(config_id)
+        self.status_latency.pop(config_id, None)
+        for key in [i for i in self.fetching if i[0] == config_id]:
+            self.fetching.discard(key)
+        self.renderer.invalidate(config_id)
+        self.log.info(f"Removed {config_id}")
+        return True
+
+    def poll_bounds(self, config_id: str, feed: str):
+        """(min, max) seconds between fetches of a feed, the advertised ttl is clamped to these"""
+        config = self.configs[config_id]
+        if feed in STATUS_FEEDS:
+            return self.min_status_seconds, config.gbfs_ttl_stations_seconds
+        return self.min_metadata_seconds, config.gbfs_ttl_data_days * 86400
+
+    def reschedule(self, config_id: str, feed: str, last_updated: Optional[int] = None, ttl: Optional[int] = None,
+                   failed: bool = False):
+        self.fetching.discard((config_id, feed))
+        if config_id not in self.configs:
+            return
+        now = time.time()
+        low, high = self.poll_bounds(config_id, feed)
+        if failed:
+            when = now + min(self.retry_seconds, high)
+        else:
+            when = next_fetch(now, last_updated, ttl, low, high)
+        self.scheduler_for(feed).schedule((config_id, feed), when)
+
+    def scheduler_for(self, feed: str) -> FeedScheduler:
+        return self.status_scheduler if feed in STATUS_FEEDS else self.scheduler
+
+    def feed_entries(self, config_id: str) -> List[GBFSIndexFeed]:
+        result = self.results.get(config_id)
+        if not result:
+            return []
+        return result.index.data.get(self.configs[config_id].language, {}).get('feeds', [])
 
     def update_data(self):
-        uninstantiated_results = set(self.configs.keys()) - set(self.results.keys())
-        other_results = set(self.configs.keys()) - uninstantiated_results
-        for ur in uninstantiated_results:
-            self.log.info(f"Updating {ur} (1st)")
-            self.do_update(ur)
-
-        # for k in other_results:
-        #     # Check if the TTL is old here
-        #     self.log.info(f"Updating {k}")
-        #     self.do_update(k)
-        #
-        for k in other_results:
-            self.log.info(f"Updating {k} stations")
-            self.do_station_update(k)
+        """Fetch whatever the scheduler says is due, new configs start with their index"""
+        now = time.time()
+        for config_id in self.configs:
+            key = (config_id, INDEX_FEED)
+            if key not in self.scheduler and key not in self.fetching:
+                self.scheduler.schedule(key, now)
+
+        due: Dict[str, Set[str]] = {}
+        for config_id, feed in self.scheduler.pop_due(now):
+            if config_id not in self.configs:
+                continue
+            self.fetching.add((config_id, feed))
+            if feed == INDEX_FEED:
+                self.log.info(f"Updating {config_id} index")
+                self.do_update(config_id)
+            else:
+                due.setdefault(config_id, set()).add(feed)
+
+        for config_id, feeds in due.items():
+            entries = [i for i in self.feed_entries(config_id) if i.name.value in feeds]
+            # feeds dropped from the index since they were scheduled
+            for feed in feeds - {i.name.value for i in entries}:
+                self.fetching.discard((config_id, feed))
+            self.log.debug(f"Updating {config_id} {', '.join(sorted(feeds))}")
+            self.fetch_feeds(config_id, entries)
+
+    def update_stations(self):
+        """The fast lane, live counts of every system are refreshed as soon as they're due"""
+        due: Dict[str, Set[str]] = {}
+        for config_id, feed in self.status_scheduler.pop_due(time.time()):
+            if config_id in self.configs:
+                self.fetching.add((config_id, feed))
+                due.setdefault(config_id, set()).add(feed)
+        for config_id, feeds in due.items():
+            self.do_station_update(config_id, feeds)
+
+    @wamp.register(GBFS_PREFIX + "neighbourhood")
+    def neighbourhood(self, config_id: str, lat: float, lon: float, radius_m: float = 250) -> Dict[str, Any]:
+        """Bikes and docks around a point, so a sign can show its area without listing station ids"""
+        result = self.results.get(config_id)
+        if not result:
+            return {}
+        return result.neighbourhood(lat, lon, radius_m)
 
+    @wamp.register(GBFS_PREFIX + "nearest_stations")
+    def nearest_stations(self, config_id: str, lat: float, lon: float, k: int = 5, min_bikes: int = 1,
+                         max_m: Optional[float] = None) -> List[Dict[str, Any]]:
+        """The k nearest stations with at least min_bikes available, to find ids for a sign"""
+        result = self.results.get(config_id)
+        if not result:
+            return []
+        return [{
+            "station_id": station.information.station_id,
+            "short_name": station.information.short_name,
+            "name": station.information.name,
+            "num_bikes_available": station.status.num_bikes_available,
+            "num_ebikes_available": station.status.num_ebikes_available,
+            "num_docks_available": station.status.num_docks_available,
+            "distance_m": round(distance, 1),
+        } for distance, station in result.nearest_stations(lat, lon, k, min_bikes, max_m)]
+
+    @inlineCallbacks
     def herald_data(self):
-        pass
+        """Publish the frames of every configured station, each is only redrawn once its status changed"""
+        options = PublishOptions(retain=True)
+        smears = self.cconfig.smears
+        for config_id, result in list(self.results.items()):
+            for station_id in result.config.stations:
+                station = result.station(station_id)
+                for smear in smears:
+                    frame = self.renderer.frame(config_id, station_id, station, smear)
+                    if frame is None:
+                        continue
+                    id = result.machine_id(station_id, smear if len(smears) > 1 else None)
+                    yield self.publish(f"{SRC_PREFIX}{id}", self.run_brightness_on_val(frame), id=id, options=options)
+        if not self.results:
+            self.log.info("Herald: No data has been loaded, chilling")
 
     @inlineCallbacks
     def onJoin(self, details):
@@ -120,46 +355,134 @@ class GBFSSession(LAMachineCompatMixin, ApplicationSession):
         self.subs = yield self.subscribe(self)
 
         self.ticker_up = LoopingCall(self.update_data)
-        self.ticker_up.start(300)  # 5m
+        self.ticker_up.start(1)  # only peeks at the scheduler unless something is due
+
+        self.ticker_stations = LoopingCall(self.update_stations)
+        self.ticker_stations.start(.5)
 
         self.herald_up = LoopingCall(self.herald_data)
         self.herald_up.start(10)
 
     @inlineCallbacks
     def do_update(self, config_id):
+        """Refresh the index, feeds new to it are fetched right away and scheduled from then on"""
+        index = None
         try:
             config = self.configs[config_id]
 
-            response: Response = yield self.retrieve_url(config.url)
-            if response:
-                json = yield response.json()
-                index = GBFSIndex(**json)
+            index = yield self.fetch_index(config.url).addTimeout(self.fetch_timeout_seconds, reactor)
+            if index:
                 if config.language not in index.data:
                     self.log.info(
                         f"The configured language '{config.language}' was not found in the GBFS index {config.url}. Found {index.data.keys()}")
                     return
 
+                if config_id not in self.configs:
+                    return
                 curr_feeds = index.data.get(config.language)['feeds']
                 if config_id not in self.results:
                     self.results[config_id] = GBFSResult(index=index, config=config)
+                else:
+                    self.results[config_id].index = index
 
-                for entry in curr_feeds:
-                    entry_response: Response = yield self.retrieve_url(entry.url)
-                    entry_json = yield entry_response.json()
-                    entry_obj = feed_to_parser[entry.name.value](**entry_json)
-                    setattr(self.results[config_id], entry.name.value, entry_obj)
+                new_feeds = [i for i in curr_feeds
+                             if (config_id, i.name.value) not in self.scheduler_for(i.name.value)
+                             and (config_id, i.name.value) not in self.fetching]
+                for entry in new_feeds:
+                    if entry.name.value in STATUS_FEEDS:
+                        # picked up by the status lane on its next tick
+                        self.status_scheduler.schedule((config_id, entry.name.value), time.time())
+                    else:
+                        self.fetching.add((config_id, entry.name.value))
+                yield self.fetch_feeds(config_id, [i for i in new_feeds if i.name.value not in STATUS_FEEDS])
 
         except Exception as e:
             import traceback
             self.log.error(traceback.format_exc())
+        finally:
+            if index:
+                self.reschedule(config_id, INDEX_FEED, index.last_updated, index.ttl)
+            else:
+                self.reschedule(config_id, INDEX_FEED, failed=True)
 
-    def do_station_update(self, config_id):
-        config = self.configs[config_id]
-        station_feeds = self.results[config_id].index.data.get(config.language)['feeds'][
-            GBFSFeedName.STATION_INFORMATION.value]
-        entry_response: Response = yield self.retrieve_url(station_feeds.url)
-        entry_json = yield entry_response.json()
-        self.results[config_id].station_status = GBFSStationStatus(**entry_json)
+    @inlineCallbacks
+    def fetch_index(self, url: str) -> Optional[GBFSIndex]:
+        response: Response = yield self.retrieve_url(url)
+        if response:
+            json = yield response.json()
+            return GBFSIndex(**json)
+
+    def fetch_feeds(self, config_id: str, feeds: List[GBFSIndexFeed], status: bool = False) -> DeferredList:
+        """Fetch sub-feeds concurrently, a feed that fails or times out is logged and doesn't hold up the others"""
+        if status not in self.fetch_semaphores:
+            self.fetch_semaphores[status] = DeferredSemaphore(
+                self.status_fetch_concurrency if status else self.fetch_concurrency)
+        semaphore = self.fetch_semaphores[status]
+
+        def timed_out(result, timeout):
+            raise TimeoutError(f"timed out after {timeout}s")
+
+        def fetch(entry: GBFSIndexFeed):
+            return self.fetch_feed(config_id, entry).addTimeout(self.fetch_timeout_seconds, reactor,
+                                                                onTimeoutCancel=timed_out)
+
+        def failed(failure, entry: GBFSIndexFeed):
+            self.log.error(f"Fetching {config_id} {entry.name.value} failed: {failure.getErrorMessage()}")
+            self.reschedule(config_id, entry.name.value, failed=True)
+
+        pending = [semaphore.run(fetch, entry).addErrback(failed, entry) for entry in feeds]
+        return DeferredList(pending, consumeErrors=True)
+
+    @inlineCallbacks
+    def fetch_feed(self, config_id: str, entry: GBFSIndexFeed):
+        entry_response: Response = yield self.retrieve_url(entry.url)
+        if not entry_response:
+            raise Exception(f"no usable response from {entry.url}")
+        entry_body = yield entry_response.content()
+        if config_id not in self.configs:
+            return
+        entry_obj = parse_feed(entry.name.value, loads(entry_body), self.configs[config_id].strict)
+        changed = self.results[config_id].set_feed(entry.name.value, entry_obj)
+        self.reschedule(config_id, entry.name.value, entry_obj.last_updated, entry_obj.ttl)
+        if changed:
+            self.stations_changed(config_id, changed)
+
+    def stations_changed(self, config_id: str, changed: Dict[str, Optional[GBFSStationStatusStation]]):
+        """Tell the listeners and the router about the stations whose status changed, or that are gone"""
+        result = self.results[config_id]
+        for station_id, status in changed.items():
+            for listener in self.station_listeners:
+                try:
+                    listener(config_id, station_id, status)
+                except Exception as e:
+                    self.log.error(f"Station listener failed for {config_id} {station_id}: {e}")
+            if self.is_connected():
+                joined = result.station(station_id)
+                self.publish(GBFS_PREFIX + "station_status",
+                             config_id=config_id,
+                             station_id=station_id,
+                             short_name=joined.information.short_name if joined else None,
+                             num_bikes_available=status.num_bikes_available if status else None,
+                             num_ebikes_available=status.num_ebikes_available if status else None,
+                             num_docks_available=status.num_docks_available if status else None,
+                             last_reported=status.last_reported if status else None)
+        self.log.debug(f"{config_id}: {len(changed)} stations changed")
+
+    @inlineCallbacks
+    def do_station_update(self, config_id: str, feeds: Set[str] = STATUS_FEEDS):
+        """Refresh station_status and free_bike_status of a system concurrently, logging how long it took"""
+        start = time.perf_counter()
+        entries = [i for i in self.feed_entries(config_id) if i.name.value in feeds]
+        for feed in feeds - {i.name.value for i in entries}:
+            self.fetching.discard((config_id, feed))
+        if not entries:
+            return
+        yield self.fetch_feeds(config_id, entries, status=True)
+        if config_id not in self.configs:
+            return
+        self.status_latency[config_id] = time.perf_counter() - start
+        self.log.debug(f"Refreshed {config_id} {', '.join(sorted(i.name.value for i in entries))} "
+                       f"in {self.status_latency[config_id] * 1000:.0f}ms")
 
 
 comp = Component(
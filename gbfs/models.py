@@ -1,9 +1,9 @@
 import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 from aenum import Enum
 from geojson_pydantic import MultiPolygon
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class GBFSFeedName(Enum):
@@ -104,13 +104,30 @@ class GBFSStationInformationStations(BaseModel):
     stations: List[GBFSStation]
 
 
-class GBFSStationInformation(BaseModel):
+class StationInformationLookup:
+    """Station lookups over data.stations, shared by the validated feed and the fast records (gbfs.records)"""
+    __slots__ = ()
+
+    def build_index(self):
+        self._by_station_id = {i.station_id: i for i in self.data.stations}
+        self._by_short_name = {i.short_name: i for i in self.data.stations}
+
+    def by_id(self, station_id) -> Optional[GBFSStation]:
+        """By short_name (as configs list them, S32011) or by station_id"""
+        return self._by_short_name.get(station_id) or self._by_station_id.get(station_id)
+
+
+class GBFSStationInformation(StationInformationLookup, BaseModel):
     data: GBFSStationInformationStations
     last_updated: int
     ttl: int
 
-    def by_id(self, station_id) -> GBFSStation:
-        return next(iter([i for i in self.data.stations if i.short_name == station_id]))
+    _by_station_id: Dict[str, GBFSStation] = PrivateAttr(default_factory=dict)
+    _by_short_name: Dict[str, GBFSStation] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.build_index()
 
 
 # Entities (Station Status)
@@ -124,7 +141,7 @@ class GBFSVehicleDock(BaseModel):
     count: int
 
 
-class GBFSStationStatus(BaseModel):
+class GBFSStationStatusStation(BaseModel):
     station_id: str
 
     vehicle_types_available: Optional[List[GBFSVehicleType]]
@@ -143,18 +160,65 @@ class GBFSStationStatus(BaseModel):
     # bluebikes (GBoston/MA) Fields
     eightd_has_available_keys: Optional[bool]
     station_status: Optional[str]
-    num_ebikes_available: Optional[str]
+    num_ebikes_available: Optional[int]
 
 
 class GBFSStationStatusData(BaseModel):
-    stations: List[GBFSStationStatus]
-
-
-class GBFSStationStatus(BaseModel):
+    stations: List[GBFSStationStatusStation]
+
+
+class StationStatusLookup:
+    """Station lookups and delta merging over data.stations, shared like StationInformationLookup"""
+    __slots__ = ()
+
+    def build_index(self):
+        self._by_station_id = {i.station_id: i for i in self.data.stations}
+
+    def by_id(self, station_id) -> Optional[GBFSStationStatusStation]:
+        return self._by_station_id.get(station_id)
+
+    def merge(self, newer: 'GBFSStationStatus') -> Tuple[List[GBFSStationStatusStation], List[str]]:
+        """Take the stations of a newer payload that reported since, keeping the others as they are
+
+        Returns the stations that changed (or appeared) and the station_ids missing from the newer payload, which
+        are dropped.
+        """
+        changed = []
+        stations = []
+        for station in newer.data.stations:
+            current = self._by_station_id.get(station.station_id)
+            if current is None or current.last_reported != station.last_reported:
+                changed.append(station)
+                self._by_station_id[station.station_id] = station
+                stations.append(station)
+            else:
+                stations.append(current)
+        self.data.stations = stations
+        dropped = []
+        if len(self._by_station_id) != len(stations):
+            dropped = list(self._by_station_id.keys() - {i.station_id for i in stations})
+            self.build_index()
+        self.last_updated = newer.last_updated
+        self.ttl = newer.ttl
+        return changed, dropped
+
+
+class GBFSStationStatus(StationStatusLookup, BaseModel):
     data: GBFSStationStatusData
     last_updated: int
     ttl: int
 
+    _by_station_id: Dict[str, GBFSStationStatusStation] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.build_index()
+
+
+class GBFSJoinedStation(NamedTuple):
+    information: GBFSStation
+    status: Optional[GBFSStationStatusStation]
+
 
 # Entities (Free Bike Status
 class GBFSFreeBikeBike(BaseModel):
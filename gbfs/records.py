@@ -0,0 +1,133 @@
+"""Trusted fast parsing of the big GBFS feeds
+
+Full validation builds a pydantic model per station and bike (station areas included), on large systems that's most
+of a refresh. These records keep only the fields we use in __slots__ classes built straight from the decoded json,
+they quack like the validated feeds (data.stations, by_id, merge, last_updated, ttl). GBFSConfig.strict opts back in.
+Payloads are decoded with ujson, pinned in requirements.txt.
+"""
+from typing import Dict, List, Optional
+
+import ujson
+
+from gbfs.models import StationInformationLookup, StationStatusLookup, feed_to_parser
+
+loads = ujson.loads
+
+
+class StationRecord:
+    __slots__ = ("station_id", "name", "short_name", "lat", "lon", "capacity")
+
+    def __init__(self, station_id: str, name: str, short_name: str, lat: float, lon: float,
+                 capacity: Optional[int]):
+        self.station_id = station_id
+        self.name = name
+        self.short_name = short_name
+        self.lat = lat
+        self.lon = lon
+        self.capacity = capacity
+
+
+class StationStatusRecord:
+    __slots__ = ("station_id", "num_bikes_available", "num_ebikes_available", "num_docks_available",
+                 "is_installed", "is_renting", "is_returning", "last_reported")
+
+    def __init__(self, station_id: str, num_bikes_available: int, num_ebikes_available: Optional[int],
+                 num_docks_available: Optional[int], is_installed: bool, is_renting: bool, is_returning: bool,
+                 last_reported: int):
+        self.station_id = station_id
+        self.num_bikes_available = num_bikes_available
+        self.num_ebikes_available = num_ebikes_available
+        self.num_docks_available = num_docks_available
+        self.is_installed = is_installed
+        self.is_renting = is_renting
+        self.is_returning = is_returning
+        self.last_reported = last_reported
+
+
+class FreeBikeRecord:
+    __slots__ = ("bike_id", "lat", "lon", "is_reserved", "is_disabled", "vehicle_type_id", "station_id",
+                 "last_reported")
+
+    def __init__(self, bike_id: str, lat: Optional[float], lon: Optional[float], is_reserved: bool,
+                 is_disabled: bool, vehicle_type_id: Optional[str], station_id: Optional[str],
+                 last_reported: Optional[int]):
+        self.bike_id = bike_id
+        self.lat = lat
+        self.lon = lon
+        self.is_reserved = is_reserved
+        self.is_disabled = is_disabled
+        self.vehicle_type_id = vehicle_type_id
+        self.station_id = station_id
+        self.last_reported = last_reported
+
+
+def _float(value) -> Optional[float]:
+    return None if value is None else float(value)
+
+
+class StationsData:
+    __slots__ = ("stations",)
+
+    def __init__(self, stations: list):
+        self.stations = stations
+
+
+class BikesData:
+    __slots__ = ("bikes",)
+
+    def __init__(self, bikes: List[FreeBikeRecord]):
+        self.bikes = bikes
+
+
+class StationInformationRecords(StationInformationLookup):
+    __slots__ = ("data", "last_updated", "ttl", "_by_station_id", "_by_short_name")
+
+    def __init__(self, payload: Dict):
+        self.data = StationsData([
+            StationRecord(i["station_id"], i["name"], i["short_name"], float(i["lat"]), float(i["lon"]),
+                          i.get("capacity"))
+            for i in payload["data"]["stations"]])
+        self.last_updated = payload["last_updated"]
+        self.ttl = payload["ttl"]
+        self.build_index()
+
+
+class StationStatusRecords(StationStatusLookup):
+    __slots__ = ("data", "last_updated", "ttl", "_by_station_id")
+
+    def __init__(self, payload: Dict):
+        self.data = StationsData([
+            StationStatusRecord(i["station_id"], i["num_bikes_available"], i.get("num_ebikes_available"),
+                                i.get("num_docks_available"), bool(i["is_installed"]), bool(i["is_renting"]),
+                                bool(i["is_returning"]), i["last_reported"])
+            for i in payload["data"]["stations"]])
+        self.last_updated = payload["last_updated"]
+        self.ttl = payload["ttl"]
+        self.build_index()
+
+
+class FreeBikeStatusRecords:
+    __slots__ = ("data", "last_updated", "ttl")
+
+    def __init__(self, payload: Dict):
+        self.data = BikesData([
+            FreeBikeRecord(i["bike_id"], _float(i.get("lat")), _float(i.get("lon")), bool(i["is_reserved"]),
+                           bool(i["is_disabled"]), i.get("vehicle_type_id"), i.get("station_id"),
+                           i.get("last_reported"))
+            for i in payload["data"]["bikes"]])
+        self.last_updated = payload["last_updated"]
+        self.ttl = payload["ttl"]
+
+
+fast_parsers = {
+    "station_information": StationInformationRecords,
+    "station_status": StationStatusRecords,
+    "free_bike_status": FreeBikeStatusRecords,
+}
+
+
+def parse_feed(name: str, payload: Dict, strict: bool = False):
+    """A decoded feed as records where we have them, as validated models when strict or for the small feeds"""
+    if not strict and name in fast_parsers:
+        return fast_parsers[name](payload)
+    return feed_to_parser[name](**payload)
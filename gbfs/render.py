@@ -0,0 +1,110 @@
+"""Station availability as LED frames, flat [r, g, b, r, g, b, ...] lists like the other data machines publish
+
+A station fills the strip in proportion to its capacity: ebikes, then classic bikes, then free docks, with anything
+left over (disabled bikes and docks) dark. A smear of N blends each boundary over N LEDs.
+"""
+import itertools
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from compat import LEDS_IN_ARRAY_DEFAULT
+from gbfs.models import GBFSJoinedStation
+
+Color = Tuple[int, int, int]
+
+EBIKE_COLOR: Color = (0, 96, 255)
+BIKE_COLOR: Color = (0, 228, 0)
+DOCK_COLOR: Color = (48, 48, 48)
+EMPTY_COLOR: Color = (0, 0, 0)
+OFFLINE_COLOR: Color = (96, 0, 0)  # not installed or not renting
+PALETTE = (EBIKE_COLOR, BIKE_COLOR, DOCK_COLOR, EMPTY_COLOR, OFFLINE_COLOR)
+
+
+def gradient(start: Color, end: Color, width: int) -> List[int]:
+    """width LEDs stepping from start towards end, flattened"""
+    flat = []
+    for step in range(width):
+        t = (step + .5) / width
+        flat.extend(int(round(a + (b - a) * t)) for a, b in zip(start, end))
+    return flat
+
+
+def segment_counts(weights: Sequence[float], leds: int) -> List[int]:
+    """Split leds between the weights, rounding the running total so the counts add up exactly"""
+    total = sum(weights)
+    if total <= 0:
+        return [0] * (len(weights) - 1) + [leds]
+    counts, placed, running = [], 0, 0.
+    for weight in weights:
+        running += weight
+        edge = int(round(running / total * leds))
+        counts.append(edge - placed)
+        placed = edge
+    return counts
+
+
+class FrameRenderer:
+    """Frames per station and smear width, redrawn only when the station's joined information/status changes
+
+    GBFSResult keeps a station's joined tuple until a delta merge or information refresh replaces it, so the cache
+    just remembers which tuple each frame was drawn from.
+    """
+
+    def __init__(self, smears: Sequence[int], leds: int = LEDS_IN_ARRAY_DEFAULT):
+        self.leds = leds
+        self.smears = list(smears)
+        # (from, to, width) -> flat gradient, for every palette pair and smear width we draw with
+        self.gradients: Dict[Tuple[Color, Color, int], List[int]] = {
+            (a, b, width): gradient(a, b, width)
+            for a, b in itertools.permutations(PALETTE, 2) for width in self.smears if width > 1
+        }
+        # (config_id, station id) -> (joined station drawn, {smear: frame})
+        self.frames: Dict[Tuple[str, str], Tuple[GBFSJoinedStation, Dict[int, List[int]]]] = {}
+        self.renders = 0
+
+    def segments(self, station: GBFSJoinedStation) -> List[Tuple[Color, int]]:
+        status = station.status
+        if not (status.is_installed and status.is_renting):
+            return [(OFFLINE_COLOR, self.leds)]
+        bikes = status.num_bikes_available or 0
+        ebikes = min(status.num_ebikes_available or 0, bikes)
+        docks = status.num_docks_available or 0
+        capacity = max(bikes + docks, station.information.capacity or 0)
+        counts = segment_counts([ebikes, bikes - ebikes, docks, capacity - bikes - docks], self.leds)
+        return [(color, count) for color, count in zip((EBIKE_COLOR, BIKE_COLOR, DOCK_COLOR, EMPTY_COLOR), counts)
+                if count]
+
+    def draw(self, segments: List[Tuple[Color, int]], smear: int) -> List[int]:
+        frame = []
+        for color, count in segments:
+            frame.extend(list(color) * count)
+        if smear <= 1:
+            return frame
+
+        edge = 0
+        for (start, count), (end, _) in zip(segments, segments[1:]):
+            edge += count
+            lo = edge - smear // 2
+            blend = self.gradients.get((start, end, smear)) or gradient(start, end, smear)
+            skip = max(0, -lo)
+            hi = min(self.leds, lo + smear)
+            frame[(lo + skip) * 3:hi * 3] = blend[skip * 3:(hi - lo) * 3]
+        return frame
+
+    def frame(self, config_id: str, station_id: str, station: GBFSJoinedStation, smear: int) -> Optional[List[int]]:
+        """The station's frame, None until its status is known"""
+        key = (config_id, station_id)
+        if station is None or station.status is None:
+            self.frames.pop(key, None)
+            return None
+        entry = self.frames.get(key)
+        if entry is None or entry[0] is not station:
+            entry = self.frames[key] = (station, {})
+        drawn = entry[1].get(smear)
+        if drawn is None:
+            self.renders += 1
+            drawn = entry[1][smear] = self.draw(self.segments(station), smear)
+        return drawn
+
+    def invalidate(self, config_id: str):
+        for key in [i for i in self.frames if i[0] == config_id]:
+            del self.frames[key]
@@ -0,0 +1,50 @@
+import heapq
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+FeedKey = Tuple[str, str]  # (config_id, feed name)
+
+
+class FeedScheduler:
+    """When each (config, feed) is next due, as a heap of due times
+
+    Rescheduling a key or removing a config leaves old heap entries behind, entries that don't match `due` are
+    skipped.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, FeedKey]] = []
+        self.due: Dict[FeedKey, float] = {}
+        self.counter = itertools.count()  # tie breaker, keys aren't compared
+
+    def __contains__(self, key: FeedKey) -> bool:
+        return key in self.due
+
+    def __len__(self):
+        return len(self.due)
+
+    def schedule(self, key: FeedKey, when: float):
+        self.due[key] = when
+        heapq.heappush(self.heap, (when, next(self.counter), key))
+
+    def remove_config(self, config_id: str):
+        for key in [i for i in self.due if i[0] == config_id]:
+            del self.due[key]
+
+    def pop_due(self, now: float) -> List[FeedKey]:
+        """Keys due at `now`, they're unscheduled until scheduled again"""
+        popped = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, key = heapq.heappop(self.heap)
+            if self.due.get(key) == when:
+                del self.due[key]
+                popped.append(key)
+        return popped
+
+
+def next_fetch(now: float, last_updated: Optional[int], ttl: Optional[int], min_seconds: float,
+               max_seconds: float) -> float:
+    """When to fetch a feed again from its advertised last_updated/ttl, kept within [min_seconds, max_seconds]"""
+    if last_updated is None or ttl is None:
+        return now + max_seconds
+    return max(now + min_seconds, min(last_updated + ttl, now + max_seconds))
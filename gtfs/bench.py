@@ -0,0 +1,64 @@
+"""Reactor latency while a bundle is ingested
+
+Run from the directory holding cache/{config_id}/bundle.zip:
+
+    python bench.py mbta            # parse in the worker pool
+    python bench.py mbta --inline   # parse on the reactor thread, how it used to be
+"""
+import argparse
+import time
+
+from autobahn.wamp.types import ComponentConfig
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+
+from main import GTFSConfig, GTFSSession
+
+TICK = .01
+
+
+class LatencyProbe:
+    """Records how late a frequent LoopingCall fires, i.e. how long the reactor was blocked"""
+
+    def __init__(self):
+        self.lags = []
+        self.last = None
+        self.call = LoopingCall(self.tick)
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.last is not None:
+            self.lags.append(max(0., now - self.last - TICK))
+        self.last = now
+
+    def report(self) -> str:
+        lags = sorted(self.lags) or [0.]
+        pick = lambda q: lags[min(len(lags) - 1, int(q * len(lags)))] * 1000
+        return f"{len(lags)} ticks, lag p50 {pick(.5):.1f}ms p99 {pick(.99):.1f}ms max {lags[-1] * 1000:.1f}ms"
+
+
+@inlineCallbacks
+def run(args):
+    session = GTFSSession(ComponentConfig(realm="realm1"))
+    session.parse_workers = 0 if args.inline else args.workers
+    session.gtfs_configs = {args.config_id: GTFSConfig(
+        name=args.config_id, gtfs_url="", transit_system_tz="UTC", ingest_from_zip=True)}
+
+    probe = LatencyProbe()
+    probe.call.start(TICK)
+    start = time.perf_counter()
+    yield session.parse_bundle(args.config_id)
+    probe.call.stop()
+    print(f"{'inline' if args.inline else f'{session.parse_workers} workers'}: "
+          f"ingest {time.perf_counter() - start:.2f}s, {probe.report()}")
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_id")
+    parser.add_argument("--inline", action="store_true")
+    parser.add_argument("--workers", type=int, default=GTFSSession.parse_workers)
+    reactor.callWhenRunning(run, parser.parse_args())
+    reactor.run()
@@ -0,0 +1,50 @@
+import datetime
+from collections import OrderedDict
+from typing import Any, List, Tuple
+
+from tables import StopTimeView
+
+
+class DepartureBoardCache:
+    """Upcoming stop times per (config, stop, minute), LRU evicted
+
+    A minute's entry covers one extra minute so every query within it is just a filter. Entries are only used with
+    the exact results and realtime version they were computed from, invalidate() drops them early to free memory.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        # (config_id, stop_id, minute, minutes) -> (results, realtime version, [(seconds, view)])
+        self.entries: 'OrderedDict[Tuple, Tuple[Any, int, List[Tuple[int, StopTimeView]]]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, config_id: str, results: Any, stop_id: str, now: datetime.datetime,
+            minutes: int = 15) -> List[StopTimeView]:
+        """What results.get_next_schedules_for_stop(stop_id, now=now, minutes=minutes) would return"""
+        bucket = now.replace(second=0, microsecond=0)
+        key = (config_id, stop_id, bucket, minutes)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is results and entry[1] == results.realtime.version:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            timed = entry[2]
+        else:
+            self.misses += 1
+            timed = results._get_timed_stop_times_between(
+                stop_id, bucket, bucket + datetime.timedelta(minutes=minutes + 1))
+            self.entries[key] = (results, results.realtime.version, timed)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        lo = bucket.hour * 3600 + bucket.minute * 60 + now.second
+        hi = lo + minutes * 60
+        return [view for seconds, view in timed if lo < seconds < hi]
+
+    def invalidate(self, config_id: str):
+        for key in [i for i in self.entries if i[0] == config_id]:
+            del self.entries[key]
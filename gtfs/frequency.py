@@ -0,0 +1,63 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import models
+from tables import NULL, StopTimeTable, gtfs_time_to_seconds
+
+
+class FrequencyIndex:
+    """Departures of frequencies.txt trips, worked out from their headway windows on demand
+
+    The stop_times of a frequency based trip only describe the travel time between its stops, so we keep each
+    stop's offset from the start of the trip and never expand the individual departures into rows.
+    """
+
+    def __init__(self, frequencies: Optional[List[models.Frequency]], table: StopTimeTable):
+        lookup = table.pool.lookup
+        # trip code -> [(start, end, headway)]
+        self.windows: Dict[int, List[Tuple[int, int, int]]] = {}
+        for i in frequencies or []:
+            code = lookup(i.trip_id)
+            if code == NULL or not i.headway_secs:
+                continue
+            self.windows.setdefault(code, []).append(
+                (gtfs_time_to_seconds(i.start_time), gtfs_time_to_seconds(i.end_time), i.headway_secs))
+
+        # stop code -> [(row, trip code, seconds after the first stop of the trip)]
+        self.stop_rows: Dict[int, List[Tuple[int, int, int]]] = {}
+        # trip code -> time of its first stop in stop_times, which the offsets are taken from
+        self.first: Dict[int, int] = {}
+        if not self.windows:
+            return
+
+        trips = table.columns["trip_id"]
+        arrivals = table.columns["arrival_time"]
+        departures = table.columns["departure_time"]
+        rows = [(row, code) for row, code in enumerate(trips) if code in self.windows]
+        times = {row: arrivals[row] if arrivals[row] != NULL else departures[row] for row, _ in rows}
+
+        for row, code in rows:
+            if times[row] != NULL and (code not in self.first or times[row] < self.first[code]):
+                self.first[code] = times[row]
+        stops = table.columns["stop_id"]
+        for row, code in rows:
+            if times[row] != NULL:
+                self.stop_rows.setdefault(stops[row], []).append((row, code, times[row] - self.first[code]))
+
+    def __contains__(self, trip_code: int) -> bool:
+        return trip_code in self.windows
+
+    def window(self, stop_code: int, start: int, end: int, active: Set[int]) -> Iterator[Tuple[int, int, int]]:
+        """(row, seconds, shift) for departures of active trips at a stop arriving strictly between start and end
+
+        shift is how far this departure is from the template time stored in the row.
+        """
+        for row, code, offset in self.stop_rows.get(stop_code, []):
+            if code not in active:
+                continue
+            template = self.first[code] + offset
+            for first, last, headway in self.windows[code]:
+                # earliest trip start with trip_start + offset > start
+                trip_start = first + max(0, (start - offset - first) // headway + 1) * headway
+                while trip_start < last and trip_start + offset < end:
+                    yield row, trip_start + offset, trip_start + offset - template
+                    trip_start += headway
@@ -0,0 +1,106 @@
+import heapq
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import models
+
+# transfers that aren't walks between stops, in-seat ones stay on the vehicle
+SKIPPED_TRANSFERS = (models.TransferType.NOT_POSSIBLE, models.TransferType.IN_SEAT, models.TransferType.NO_IN_SEAT)
+WALK_SPEED_MPS = 1.3
+
+
+class StopGraph:
+    """Walking connections between stops from transfers.txt and pathways.txt, stored CSR style
+
+    edges leaving node n live in [offsets[n], offsets[n + 1]) of targets/weights, weights are in seconds.
+    Stations without pathways get their platforms linked through the parent station at station_walk_seconds.
+    """
+
+    def __init__(self, stops: List[models.Stop], transfers: Optional[List[models.Transfer]],
+                 pathways: Optional[List[models.Pathway]], station_walk_seconds: int = 60):
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.parents: Dict[str, str] = {}
+        self.children: Dict[str, List[str]] = {}
+        for stop in stops:
+            if stop.parent_station:
+                self.parents[stop.stop_id] = stop.parent_station
+                self.children.setdefault(stop.parent_station, []).append(stop.stop_id)
+
+        edges: Dict[Tuple[int, int], int] = {}
+
+        def add(source: str, target: str, weight: int):
+            if source == target:
+                return
+            key = (self._node(source), self._node(target))
+            edges[key] = min(weight, edges.get(key, weight))
+
+        for transfer in transfers or []:
+            if transfer.transfer_type in SKIPPED_TRANSFERS:
+                continue
+            add(transfer.from_stop_id, transfer.to_stop_id, transfer.min_transfer_time or 0)
+
+        with_pathways = set()
+        for pathway in pathways or []:
+            weight = self._traversal_seconds(pathway)
+            add(pathway.from_stop_id, pathway.to_stop_id, weight)
+            if pathway.is_bidirectional == models.BiDirectionality.BIDIRECTIONAL:
+                add(pathway.to_stop_id, pathway.from_stop_id, weight)
+            for stop_id in (pathway.from_stop_id, pathway.to_stop_id):
+                with_pathways.add(self.parents.get(stop_id, stop_id))
+
+        for station, children in self.children.items():
+            if station in with_pathways:
+                continue
+            for child in children:
+                add(child, station, station_walk_seconds // 2)
+                add(station, child, station_walk_seconds - station_walk_seconds // 2)
+
+        self.offsets = array('i', [0]) * (len(self.ids) + 1)
+        self.targets = array('i')
+        self.weights = array('i')
+        for (source, target), weight in sorted(edges.items()):
+            self.offsets[source + 1] += 1
+            self.targets.append(target)
+            self.weights.append(weight)
+        for node in range(len(self.ids)):
+            self.offsets[node + 1] += self.offsets[node]
+
+    def _node(self, stop_id: str) -> int:
+        node = self.index.get(stop_id)
+        if node is None:
+            node = self.index[stop_id] = len(self.ids)
+            self.ids.append(stop_id)
+        return node
+
+    @staticmethod
+    def _traversal_seconds(pathway: models.Pathway) -> int:
+        if pathway.traversal_time is not None:
+            return pathway.traversal_time
+        if pathway.length is not None:
+            return int(pathway.length / WALK_SPEED_MPS)
+        return 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def reachable_within(self, stop_id: str, max_seconds: int) -> Dict[str, int]:
+        """stop_id -> shortest walk in seconds for every stop reachable within max_seconds, the start included"""
+        start = self.index.get(stop_id)
+        if start is None:
+            return {stop_id: 0}
+
+        best = {start: 0}
+        heap = [(0, start)]
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if cost > best[node]:
+                continue
+            for edge in range(offsets[node], offsets[node + 1]):
+                total = cost + weights[edge]
+                target = targets[edge]
+                if total <= max_seconds and total < best.get(target, max_seconds + 1):
+                    best[target] = total
+                    heapq.heappush(heap, (total, target))
+        return {self.ids[node]: cost for node, cost in best.items()}
@@ -0,0 +1,212 @@
+import hashlib
+import io
+import json
+import os
+import resource
+import sys
+import time
+import zipfile
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple, Type
+
+import models
+from schema import CoercionStats, intern_rows, iter_models
+from shapes import ShapeStore
+from tables import StopIndex, StopTimeTable, TripIndex
+
+# tables that stream into a column store rather than a list of models
+COLUMNAR = {
+    models.StopTime: StopTimeTable,
+    models.Shape: ShapeStore,
+}
+
+BUNDLE_EXPANSION = 10  # parsed results take roughly this many times the size of bundle.zip
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes on macos, kilobytes elsewhere
+        rss /= 1024
+    return rss / 1024.
+
+
+@dataclass
+class TableStats:
+    name: str
+    rows: int = 0
+    seconds: float = 0.
+    peak_rss_mb: float = 0.  # of the process that parsed it
+    coercion: CoercionStats = field(default_factory=CoercionStats)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.
+
+    def __str__(self):
+        text = f"{self.name}: {self.rows} rows in {self.seconds:.2f}s ({self.rows_per_second:,.0f} rows/s), " \
+               f"peak rss {self.peak_rss_mb:.1f}MB"
+        if self.coercion.invalid:
+            invalid = ", ".join(f"{k}={v}" for k, v in sorted(self.coercion.invalid.items()))
+            text += f", invalid values nulled: {invalid}"
+        return text
+
+
+@dataclass
+class IngestStats:
+    config_id: str
+    tables: List[TableStats] = field(default_factory=list)
+    rss_before_mb: float = field(default_factory=peak_rss_mb)
+    started: float = field(default_factory=time.perf_counter)
+    finished: float = 0.
+
+    def add(self, table: TableStats):
+        self.tables.append(table)
+        self.finished = time.perf_counter()
+
+    @property
+    def rows(self) -> int:
+        return sum(i.rows for i in self.tables)
+
+    @property
+    def seconds(self) -> float:
+        """Wall time, tables may have been parsed in parallel"""
+        return self.finished - self.started if self.finished else 0.
+
+    def summary(self) -> str:
+        rate = self.rows / self.seconds if self.seconds else 0.
+        worker_rss = max([i.peak_rss_mb for i in self.tables] + [0.])
+        return f"{self.config_id}: {self.rows} rows in {self.seconds:.2f}s ({rate:,.0f} rows/s), " \
+               f"peak rss {peak_rss_mb():.1f}MB (was {self.rss_before_mb:.1f}MB), largest parser {worker_rss:.1f}MB"
+
+
+def intern_tables(tables: Dict[str, Any]) -> None:
+    """Intern the strings of freshly unpickled list tables, columnar tables intern their pools themselves"""
+    for table in tables.values():
+        if isinstance(table, list):
+            intern_rows(table)
+
+
+def estimate_nbytes(table: Any, sample: int = 64) -> int:
+    """Rough in-memory size of a table, list tables are extrapolated from a sample of rows
+
+    Strings of list tables aren't counted as they're interned and largely shared between feeds.
+    """
+    if table is None:
+        return 0
+    if hasattr(table, "nbytes"):
+        return table.nbytes
+    if not isinstance(table, list) or not table:
+        return sys.getsizeof(table)
+    rows = table[::max(1, len(table) // sample)]
+    per_row = sum(sys.getsizeof(i) + sys.getsizeof(i.__dict__) for i in rows) / len(rows)
+    return int(sys.getsizeof(table) + per_row * len(table))
+
+
+def bundle_digest(config_id: str) -> Optional[str]:
+    """sha256 of the downloaded bundle.zip, used to key snapshots"""
+    path = f"cache/{config_id}/bundle.zip"
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class BundleMeta:
+    """What we know about the last bundle.zip download, kept next to it as bundle.json"""
+    digest: Optional[str] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    checked: float = 0.  # unix time of the last download or 304 from the server
+
+
+def read_bundle_meta(config_id: str) -> BundleMeta:
+    try:
+        with open(f"cache/{config_id}/bundle.json", 'r') as source:
+            return BundleMeta(**json.load(source))
+    except (OSError, ValueError, TypeError):
+        return BundleMeta()
+
+
+def write_bundle_meta(config_id: str, meta: BundleMeta) -> None:
+    with open(f"cache/{config_id}/bundle.json", 'w') as destination:
+        json.dump(asdict(meta), destination)
+
+
+def table_digests(config_id: str, from_zip: bool = False) -> Dict[str, str]:
+    """table name -> content hash of its file, the zip's crc32 and size when reading from the zip"""
+    digests = {}
+    if from_zip:
+        with zipfile.ZipFile(f"cache/{config_id}/bundle.zip", 'r') as zip:
+            for info in zip.infolist():
+                if not info.is_dir():
+                    digests[os.path.basename(info.filename).replace('.txt', '')] = f"{info.CRC:08x}-{info.file_size}"
+        return digests
+
+    for file in os.listdir(f"cache/{config_id}/bundle"):
+        digest = hashlib.sha1()
+        with open(f"cache/{config_id}/bundle/{file}", 'rb') as source:
+            for chunk in iter(lambda: source.read(1 << 20), b""):
+                digest.update(chunk)
+        digests[file.replace('.txt', '')] = digest.hexdigest()
+    return digests
+
+
+def list_bundle_files(config_id: str, from_zip: bool = False) -> List[str]:
+    if from_zip:
+        with zipfile.ZipFile(f"cache/{config_id}/bundle.zip", 'r') as zip:
+            return sorted(os.path.basename(i.filename) for i in zip.infolist() if not i.is_dir())
+    return sorted(os.listdir(f"cache/{config_id}/bundle"))
+
+
+@contextmanager
+def open_bundle_file(config_id: str, file: str, from_zip: bool = False) -> Iterator[TextIO]:
+    """Text handle on one file of a bundle, either extracted on disk or straight out of the zip"""
+    if from_zip:
+        with zipfile.ZipFile(f"cache/{config_id}/bundle.zip", 'r') as zip:
+            info = next(i for i in zip.infolist() if os.path.basename(i.filename) == file)
+            with zip.open(info) as raw:
+                yield io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    else:
+        with open(f"cache/{config_id}/bundle/{file}", 'r', encoding="utf-8-sig", newline="") as file_handle:
+            yield file_handle
+
+
+def parse_file(config_id: str, file: str, parser: Type, from_zip: bool = False) -> Tuple[Dict[str, Any], TableStats]:
+    """Parse a single table file into GTFSResults kwargs
+
+    Everything in and out is picklable so this can run in a worker process, columnar tables come back with their
+    stop and trip indexes already built so the sorts don't happen on the reactor.
+    """
+    name = file.replace('.txt', '')
+    stats = TableStats(name=name)
+    start = time.perf_counter()
+    with open_bundle_file(config_id, file, from_zip) as file_handle:
+        table = load_table(file_handle, parser, stats)
+    parsed = {name: table}
+    if isinstance(table, StopTimeTable):
+        parsed["stop_index"] = StopIndex(table)
+        parsed["trip_index"] = TripIndex(table)
+    stats.seconds = time.perf_counter() - start
+    stats.peak_rss_mb = peak_rss_mb()
+    return parsed, stats
+
+
+def iter_rows(file_handle: TextIO, parser: Type, coercion: Optional[CoercionStats] = None) -> Iterator:
+    """Build one parser object per csv row, columns are coerced to the declared field types a chunk at a time"""
+    return iter_models(file_handle, parser, coercion if coercion is not None else CoercionStats())
+
+
+def load_table(file_handle: TextIO, parser: Type, stats: TableStats):
+    if parser in COLUMNAR:
+        table = COLUMNAR[parser].from_csv(file_handle, coercion=stats.coercion)
+        stats.rows = stats.coercion.rows
+        return table
+
+    rows = list(iter_rows(file_handle, parser, stats.coercion))
+    stats.rows = len(rows)
+    return rows
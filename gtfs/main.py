@@ -1,9 +1,16 @@
-import csv
+import copy
+import dataclasses
 import datetime
+import multiprocessing
 import os
+import shutil
+import sys
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
 from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Set, Tuple
 
 import pytz
 import treq
@@ -12,12 +19,24 @@ from autobahn import wamp
 from autobahn.twisted import ApplicationSession
 from autobahn.twisted.component import Component
 from autobahn.twisted.component import run
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, gatherResults, inlineCallbacks, maybeDeferred
 from twisted.internet.task import LoopingCall
 from twisted.web._newclient import Response
 
+import ingest
 import models
+import realtime
+import snapshot
+from board import DepartureBoardCache
+from frequency import FrequencyIndex
+from graph import StopGraph
+from realtime import RealtimeState
+from service import ServiceCalendar, parse_gtfs_date, service_day_start
+from shapes import ShapeStore
+from tables import StopIndex, StopTimeTable, StopTimeView, TripIndex
 from config import NAMESPACE_PREFIX
+from spatial import GridIndex
 
 GTFS_PREFIX = NAMESPACE_PREFIX + "gtfs."
 ns = "LA4-DATA-GTFS"
@@ -50,6 +69,13 @@ class GTFSRTEnum(Enum):
     VEHICLE_POSITIONS = "VehiclePositions"
 
 
+def _group_by(rows: List[Any], attr: str) -> Dict[str, List[Any]]:
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(getattr(row, attr), []).append(row)
+    return grouped
+
+
 @dataclass
 class GTFSResults:
     timestamp: datetime.datetime
@@ -57,12 +83,12 @@ class GTFSResults:
     stops: List[models.Stop]
     routes: List[models.Route]
     trips: List[models.Trip]
-    stop_times: List[models.StopTime]
+    stop_times: StopTimeTable
     calendar: Optional[List[models.Calendar]] = None
     calendar_dates: Optional[List[models.CalendarDate]] = None
     fare_attributes: Optional[List[models.FareAttribute]] = None
     fare_rules: Optional[List[models.FareRule]] = None
-    shapes: Optional[List[models.Shape]] = None
+    shapes: Optional[ShapeStore] = None
     frequencies: Optional[List[models.Frequency]] = None
     transfers: Optional[List[models.Transfer]] = None
     pathways: Optional[List[models.Pathway]] = None
@@ -70,46 +96,198 @@ class GTFSResults:
     feed_info: Optional[List[models.FeedInfo]] = None
     translations: Optional[List[models.Translation]] = None
     attributions: Optional[List[models.Attribution]] = None
+    digest: Optional[str] = None  # sha256 of the bundle these results were parsed from
+    table_digests: Dict[str, str] = field(default_factory=dict)  # per file, to only re-parse what changed
+
+    # indexes, built once at ingest
+    stops_by_id: Dict[str, models.Stop] = field(init=False, repr=False)
+    trips_by_id: Dict[str, models.Trip] = field(init=False, repr=False)
+    routes_by_id: Dict[str, models.Route] = field(init=False, repr=False)
+    trips_by_service_id: Dict[str, List[models.Trip]] = field(init=False, repr=False)
+    stop_index: Optional[StopIndex] = field(default=None, repr=False)  # may be handed in from a snapshot
+    trip_index: Optional[TripIndex] = field(default=None, repr=False)  # same, resolves gtfs-rt stop times
+    service_calendar: ServiceCalendar = field(init=False, repr=False)
+    frequency_index: FrequencyIndex = field(init=False, repr=False)
+    stop_graph: StopGraph = field(init=False, repr=False)
+    stop_grid: GridIndex = field(init=False, repr=False)
+    _active_trips: Dict[datetime.date, Set[int]] = field(init=False, repr=False, default_factory=dict)
+    realtime: RealtimeState = field(init=False, repr=False, default_factory=RealtimeState)
+
+    def __post_init__(self):
+        self.build_indexes()
+
+    def build_indexes(self, tables: Optional[Set[str]] = None):
+        """(Re)build the indexes, limited to the ones reading from `tables` if given"""
+        def stale(*dependencies: str) -> bool:
+            return tables is None or not tables.isdisjoint(dependencies)
+
+        if stale("stops"):
+            self.stops_by_id = {i.stop_id: i for i in self.stops}
+            self.stop_grid = GridIndex()
+            for i in self.stops:
+                if i.stop_lat is not None and i.stop_lon is not None:
+                    self.stop_grid.insert(i.stop_id, i.stop_lat, i.stop_lon)
+        if stale("trips"):
+            self.trips_by_id = {i.trip_id: i for i in self.trips}
+            self.trips_by_service_id = _group_by(self.trips, "service_id")
+        if stale("routes"):
+            self.routes_by_id = {i.route_id: i for i in self.routes}
+        if self.stop_index is None or self.stop_index.table is not self.stop_times:
+            self.stop_index = StopIndex(self.stop_times)
+        if self.trip_index is None or self.trip_index.table is not self.stop_times:
+            self.trip_index = TripIndex(self.stop_times)
+        if stale("calendar", "calendar_dates"):
+            self.service_calendar = ServiceCalendar(self.calendar, self.calendar_dates)
+        if stale("frequencies", "stop_times"):
+            self.frequency_index = FrequencyIndex(self.frequencies, self.stop_times)
+        if stale("stops", "transfers", "pathways"):
+            self.stop_graph = StopGraph(self.stops, self.transfers, self.pathways)
+        if stale("trips", "stop_times", "calendar", "calendar_dates"):
+            self._active_trips = {}
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated memory held by the tables and the stop/trip indexes, caches excluded"""
+        return sum(ingest.estimate_nbytes(getattr(self, i.name)) for i in dataclasses.fields(self) if i.init)
+
+    def trim_caches(self):
+        """Drop the query caches, they're cheap to fill again unlike the indexes"""
+        self._active_trips = {}
+        if self.shapes is not None:
+            self.shapes.clear_cache()
+
+    def with_tables(self, **tables: Any) -> 'GTFSResults':
+        """A copy with some tables replaced, only the indexes depending on them are rebuilt"""
+        results = copy.copy(self)
+        for name, value in tables.items():
+            setattr(results, name, value)
+        results.build_indexes(set(tables))
+        return results
 
     # utilities
     def _get_stop_by_id(self, id: str) -> Optional[models.Stop]:
-        return next(iter([i for i in self.stops if i.stop_id == id]))
+        return self.stops_by_id.get(id)
 
-    def _get_stop_times_by_id(self, id: str) -> List[models.StopTime]:
-        return [i for i in self.stop_times if i.stop_id == id]
+    def _get_route_by_id(self, id: str) -> Optional[models.Route]:
+        return self.routes_by_id.get(id)
 
-    def _get_trips_by_id(self, id: List[str]) -> Dict[str, models.Trip]:
-        return {i.trip_id:i for i in self.trips if i.trip_id in id}
+    def _get_trips_by_service_id(self, id: str) -> List[models.Trip]:
+        return self.trips_by_service_id.get(id, [])
 
-    def _filter_to_find_closest_times(self, stop_times: List[models.StopTime], start: datetime.datetime, end: datetime.datetime, end_of_service_hour: int = 2) -> List[models.StopTime]:
-        startstr = start.strftime("%H:%M:%S")
-        endstr = end.strftime("%H:%M:%S")
+    def _get_shape_by_id(self, id: str, tolerance_m: float = 0.) -> List[Tuple[float, float]]:
+        """(lat, lon) polyline of a shape, decimated to within tolerance_m meters if given"""
+        if self.shapes is None:
+            return []
+        return self.shapes.simplified(id, tolerance_m) if tolerance_m else self.shapes.polyline(id)
 
-        if start.hour <= end_of_service_hour: # handle the dumb 24h logic in gtfs
-            startstr = str(int(startstr[0:2]) + 24) + startstr[2:]
-        if end.hour <= end_of_service_hour:
-            endstr = str(int(endstr[0:2]) + 24) + endstr[2:]
+    def _get_stop_times_by_id(self, id: str) -> List[StopTimeView]:
+        return [self.stop_times[row] for row in self.stop_index.rows_for_stop(id)]
 
-        things_coming_up = [i for i in stop_times if i.arrival_time > startstr ]
-        things_within_bounds = [i for i in things_coming_up if i.arrival_time < endstr ]
-
-        # print(things_within_bounds)
-        # print([i.arrival_time for i in things_within_bounds])
-        return things_within_bounds
+    def _get_trips_by_id(self, id: List[str]) -> Dict[str, models.Trip]:
+        return {i: self.trips_by_id[i] for i in id if i in self.trips_by_id}
+
+    def is_service_active(self, service_id: str, date: datetime.date) -> bool:
+        return self.service_calendar.is_service_active(service_id, date)
+
+    @property
+    def timezone(self) -> datetime.tzinfo:
+        agency_tz = next(iter([i.agency_timezone for i in self.agency if i.agency_timezone]), None)
+        return pytz.timezone(agency_tz) if agency_tz else pytz.utc
+
+    def resolve_stop_time(self, trip_id: str, stop_sequence: Optional[int], stop_id: Optional[str],
+                          start_date: Optional[str]) -> Optional[Tuple[int, int]]:
+        """(stop_sequence, scheduled unix time) of a trip's stop, used to turn gtfs-rt absolute times into delays"""
+        tz = self.timezone
+        date = parse_gtfs_date(start_date) if start_date else datetime.datetime.now(tz=tz).date()
+        for row in self.trip_index.rows_for_trip(trip_id):
+            view = self.stop_times[row]
+            if (stop_sequence is not None and view.stop_sequence == stop_sequence) or \
+                    (stop_sequence is None and view.stop_id == stop_id):
+                seconds = view.arrival_seconds if view.arrival_seconds is not None else view.departure_seconds
+                if seconds is None:
+                    return None
+                return view.stop_sequence, int(service_day_start(date, tz).timestamp()) + seconds
+        return None
+
+    def _predict(self, row: int, seconds: int, shift: int = 0) -> Optional[Tuple[int, StopTimeView]]:
+        """Apply any live delay to a scheduled stop time, None if it won't be served"""
+        view = StopTimeView(self.stop_times, row, shift)
+        if not self.realtime.trips:
+            return seconds, view
+        delay = self.realtime.delay_for(view.trip_id, view.stop_sequence, view.stop_id)
+        if delay is None:
+            return None
+        view.shift += delay
+        return seconds + delay, view
+
+    def _get_active_trip_codes(self, date: datetime.date) -> Set[int]:
+        """stop_times trip codes running on a service date, cached as every query of the day shares it"""
+        active = self._active_trips.get(date)
+        if active is None:
+            if len(self._active_trips) > 4:
+                self._active_trips.clear()
+            lookup = self.stop_times.pool.lookup
+            active = self._active_trips[date] = {
+                lookup(t.trip_id)
+                for service_id in self.service_calendar.active_services(self.trips_by_service_id, date)
+                for t in self.trips_by_service_id[service_id]
+            }
+        return active
+
+    def _get_stop_times_between(self, id: str, start: datetime.datetime, end: datetime.datetime) -> List[StopTimeView]:
+        return [i for _, i in self._get_timed_stop_times_between(id, start, end)]
+
+    def _get_timed_stop_times_between(self, id: str, start: datetime.datetime, end: datetime.datetime
+                                      ) -> List[Tuple[int, StopTimeView]]:
+        """(seconds since the start of the service day of `start`, stop time), sorted"""
+        start_s = start.hour * 3600 + start.minute * 60 + start.second
+        end_s = start_s + int((end - start).total_seconds())
+        trip_codes = self.stop_times.columns["trip_id"]
+
+        # widen the static window by the known live delays so trips shifted into it are found
+        late, early = self.realtime.latest, self.realtime.earliest
+
+        # gtfs times run past 24:00:00, so yesterday's late trips are the same window shifted by a day
+        found = []
+        for day_offset in (0, 86400):
+            active = self._get_active_trip_codes(start.date() - datetime.timedelta(seconds=day_offset))
+            if not active:
+                continue
+            lo, hi = start_s + day_offset, end_s + day_offset
+            candidates = [(row, seconds, 0) for row, seconds in self.stop_index.window(id, lo - late, hi - early)
+                          # frequency based trips are only templates here, their departures come from the headways
+                          if trip_codes[row] in active and trip_codes[row] not in self.frequency_index]
+            candidates += self.frequency_index.window(self.stop_times.pool.lookup(id), lo - late, hi - early, active)
+            for row, seconds, shift in candidates:
+                predicted = self._predict(row, seconds, shift)
+                if predicted and lo < predicted[0] < hi:
+                    found.append((predicted[0] - day_offset, predicted[1]))
+        return sorted(found, key=lambda x: x[0])
 
     # high level
-    def get_next_schedules_for_stop(self, id: str, tz: str = "America/New_York", minutes: int = 15):
-        now = datetime.datetime.now(tz=pytz.timezone(tz))
-        fut = now + datetime.timedelta(minutes=15)
-
-        stop_times = self._get_stop_times_by_id(id)
-        nearby_times = self._filter_to_find_closest_times(stop_times, now, fut)
-        trips = self._get_trips_by_id([i.trip_id for i in nearby_times])
-        self.log.info("Upcoming")
-        for t in sorted(nearby_times, key=lambda x:x.arrival_time):
-            self.log.info(
-                f"Line {trips[t.trip_id].route_id} Arrives at {t.arrival_time} {t.arrival_time_as_delta_seconds(now)} ")
-
+    def get_next_schedules_for_stop(self, id: str, tz: str = "America/New_York", minutes: int = 15,
+                                    now: Optional[datetime.datetime] = None) -> List[StopTimeView]:
+        now = now or datetime.datetime.now(tz=pytz.timezone(tz))
+        fut = now + datetime.timedelta(minutes=minutes)
+        return self._get_stop_times_between(id, now, fut)
+
+    def get_reachable_departures(self, id: str, walk_minutes: int = 5, tz: str = "America/New_York",
+                                 minutes: int = 15, now: Optional[datetime.datetime] = None
+                                 ) -> List[Tuple[int, StopTimeView]]:
+        """(walk seconds, stop time) of departures that can be caught from a stop or entrance, soonest first
+
+        Every stop within walk_minutes through transfers and pathways is searched from the moment it can be reached.
+        """
+        now = now or datetime.datetime.now(tz=pytz.timezone(tz))
+        end = now + datetime.timedelta(minutes=minutes)
+        found = []
+        for stop_id, walk in self.stop_graph.reachable_within(id, walk_minutes * 60).items():
+            start = now + datetime.timedelta(seconds=walk)
+            # seconds are relative to the day of start, which is the day of now bar walks across midnight
+            offset = (start.date() - now.date()).days * 86400
+            for seconds, view in self._get_timed_stop_times_between(stop_id, start, end):
+                found.append((seconds + offset, walk, view))
+        return [(walk, view) for _, walk, view in sorted(found, key=lambda x: x[0])]
 
 
 @dataclass
@@ -124,6 +302,8 @@ class GTFSConfig:
     gtfs_ttl_days: int = 1
     gtfsrt_ttl_seconds: int = 300
 
+    ingest_from_zip: bool = False  # stream members out of bundle.zip instead of extracting them first
+
 
 class GTFSSession(ApplicationSession):
     # gtfs_configs: Dict[str, GTFSConfig] = field(default_factory=list)
@@ -136,6 +316,15 @@ class GTFSSession(ApplicationSession):
     )}
 
     gtfs_results: Dict[str, GTFSResults] = {}
+    gtfsrt_fetched: Dict[Tuple[str, GTFSRTEnum], float] = {}
+    gtfs_updating: Set[str] = set()
+
+    parse_workers: int = os.cpu_count() or 1  # 0 parses on the reactor thread
+    parse_pool: Optional[ProcessPoolExecutor] = None
+    # soft limit on the estimated size of all results, None for no limit. New configs are refused when what they left
+    # on disk wouldn't fit and caches are trimmed once it's exceeded, feeds growing past it are still loaded
+    memory_budget_mb: Optional[float] = None
+    departure_cache = DepartureBoardCache()
 
     @inlineCallbacks
     def onJoin(self, details):
@@ -149,16 +338,100 @@ class GTFSSession(ApplicationSession):
         self.herald_stfs = LoopingCall(self.gtfs_herald)
         self.herald_stfs.start(10)
 
-        # self.ticker_gtfs_rt = LoopingCall(self.ticker_update_gtfs_rt)
-        # self.ticker_gtfs_rt.start(10)
+        self.ticker_gtfs_rt = LoopingCall(self.ticker_update_gtfs_rt)
+        self.ticker_gtfs_rt.start(5)
 
     @wamp.register(GTFS_PREFIX + "register")
-    def register_config(self):
-        pass
-
-    @wamp.register(GTFS_PREFIX + "register")
-    def remove_config(self):
-        pass
+    def register_config(self, config_id: str, config: Dict[str, Any]) -> bool:
+        """Add or replace a config, its bundle is fetched on the spot rather than on the next tick"""
+        if not config_id or os.path.basename(config_id) != config_id:
+            self.log.error(f"Refusing to register {config_id!r}, it is used as a cache directory name")
+            return False
+        try:
+            config = dict(config)
+            config["gtfsrt_urls"] = {GTFSRTEnum(k): v for k, v in config.get("gtfsrt_urls", {}).items()}
+            gtfs_config = GTFSConfig(**config)
+            pytz.timezone(gtfs_config.transit_system_tz)
+        except (TypeError, ValueError, pytz.UnknownTimeZoneError) as e:
+            self.log.error(f"Invalid config for {config_id}: {e}")
+            return False
+        if config_id not in self.gtfs_configs and self.memory_budget_mb is not None:
+            needed = self.memory_used_mb() + self.estimate_config_mb(config_id)
+            if needed > self.memory_budget_mb:
+                self.log.error(f"Refusing to register {config_id}, about {needed:.0f}MB would be used of "
+                               f"{self.memory_budget_mb:.0f}MB")
+                return False
+
+        previous = self.gtfs_configs.get(config_id)
+        self.gtfs_configs[config_id] = gtfs_config
+        if previous and previous.gtfs_url != gtfs_config.gtfs_url:
+            # the bundle, its extraction and the snapshot on disk all belong to the old feed
+            self.gtfs_results.pop(config_id, None)
+            self.departure_cache.invalidate(config_id)
+            shutil.rmtree(f"cache/{config_id}", ignore_errors=True)
+        self.log.info(f"Registered {config_id}")
+        self.guarded_update(config_id)
+        return True
+
+    @wamp.register(GTFS_PREFIX + "remove")
+    def remove_config(self, config_id: str) -> bool:
+        """Stop serving a config and free its results, the cache on disk is kept for a later re-register"""
+        if self.gtfs_configs.pop(config_id, None) is None:
+            return False
+        self.gtfs_results.pop(config_id, None)
+        self.departure_cache.invalidate(config_id)
+        for key in [i for i in self.gtfsrt_fetched if i[0] == config_id]:
+            del self.gtfsrt_fetched[key]
+        self.log.info(f"Removed {config_id}")
+        return True
+
+    def config_changed(self, config_id: str, config: GTFSConfig) -> bool:
+        """Whether config_id was removed or pointed at another feed since config was read"""
+        current = self.gtfs_configs.get(config_id)
+        return current is None or current.gtfs_url != config.gtfs_url
+
+    def memory_used_mb(self) -> float:
+        return sum(i.nbytes for i in self.gtfs_results.values()) / 1024 / 1024
+
+    def estimate_config_mb(self, config_id: str) -> float:
+        """Expected size of a config's results from its snapshot or bundle left on disk, 0 when there's neither"""
+        nbytes = snapshot.snapshot_nbytes(config_id)
+        if not nbytes and os.path.isfile(f"cache/{config_id}/bundle.zip"):
+            nbytes = os.path.getsize(f"cache/{config_id}/bundle.zip") * ingest.BUNDLE_EXPANSION
+        return nbytes / 1024 / 1024
+
+    def over_memory_budget(self) -> bool:
+        return self.memory_budget_mb is not None and self.memory_used_mb() > self.memory_budget_mb
+
+    def enforce_memory_budget(self):
+        """Trim the query caches of every config once the estimate goes past the budget"""
+        if not self.over_memory_budget():
+            return
+        for config_id, results in self.gtfs_results.items():
+            results.trim_caches()
+            self.departure_cache.invalidate(config_id)
+        self.log.warn(f"Over the memory budget, {self.memory_used_mb():.0f}MB of {self.memory_budget_mb:.0f}MB "
+                      f"used by {', '.join(self.gtfs_results)}")
+
+    @wamp.register(GTFS_PREFIX + "nearest_stops")
+    def nearest_stops(self, config_id: str, lat: float, lon: float, k: int = 5,
+                      radius_m: Optional[float] = None) -> List[Dict[str, Any]]:
+        """The k nearest stops to a point, or every stop within radius_m when given, to find ids for a sign"""
+        results = self.gtfs_results.get(config_id)
+        if not results:
+            return []
+        if radius_m is not None:
+            found = results.stop_grid.within(lat, lon, radius_m)
+        else:
+            found = results.stop_grid.nearest(lat, lon, k)
+        stops = [(distance, results.stops_by_id[stop_id]) for distance, stop_id in found]
+        return [{
+            "stop_id": stop.stop_id,
+            "stop_name": stop.stop_name,
+            "location_type": int(stop.location_type) if stop.location_type is not None else None,
+            "parent_station": stop.parent_station,
+            "distance_m": round(distance, 1),
+        } for distance, stop in stops]
 
     @wamp.register(GTFS_PREFIX + "assert_url")
     @inlineCallbacks
@@ -182,65 +455,250 @@ class GTFSSession(ApplicationSession):
 
     @inlineCallbacks
     def download_and_write(self, config_id: str) -> bool:
+        """Fetch the bundle unless the server says it's unchanged, returns whether bundle.zip has new content"""
         config = self.gtfs_configs[config_id]
-        bundle = yield self.retrieve_url(config.gtfs_url, kwargs={"unbuffered": True})
-        if bundle:
-            destination = open(f"cache/{config_id}/bundle.zip", 'wb')
+        meta = ingest.read_bundle_meta(config_id)
+        headers = {}
+        if os.path.isfile(f"cache/{config_id}/bundle.zip"):
+            if meta.etag:
+                headers["If-None-Match"] = meta.etag
+            if meta.last_modified:
+                headers["If-Modified-Since"] = meta.last_modified
+
+        bundle: Response = yield treq.get(config.gtfs_url, headers=headers, unbuffered=True)
+        if bundle.code == 304:
+            self.log.info(f"{config_id} bundle not modified")
+            meta.checked = time.time()
+            ingest.write_bundle_meta(config_id, meta)
+            return False
+        if bundle.code not in [200, 201, 202]:
+            self.log.error(f"{config_id} bundle download failed with {bundle.code}")
+            return False
+
+        # write aside so a failed transfer doesn't clobber the last good bundle
+        with open(f"cache/{config_id}/bundle.zip.tmp", 'wb') as destination:
             yield treq.collect(bundle, destination.write)
-            destination.close()
+        os.replace(f"cache/{config_id}/bundle.zip.tmp", f"cache/{config_id}/bundle.zip")
+
+        digest = yield threads.deferToThread(ingest.bundle_digest, config_id)
+        changed = digest != meta.digest
+        ingest.write_bundle_meta(config_id, ingest.BundleMeta(
+            digest=digest,
+            etag=(bundle.headers.getRawHeaders("ETag") or [None])[0],
+            last_modified=(bundle.headers.getRawHeaders("Last-Modified") or [None])[0],
+            checked=time.time(),
+        ))
+        return changed
 
     def unzip_bundle(self, config_id: str):
+        # clear out the previous bundle, files dropped from the feed shouldn't linger
+        shutil.rmtree(f"cache/{config_id}/bundle", ignore_errors=True)
         with zipfile.ZipFile(f"cache/{config_id}/bundle.zip", 'r') as zip:
             zip.extractall(f"cache/{config_id}/bundle")
         # print(os.listdir(f"cache/{config_id}/bundle"))
 
+    def run_parser(self, fn, *args) -> Deferred:
+        """Run fn in the parser process pool, or inline when parse_workers is 0"""
+        if not self.parse_workers:
+            return maybeDeferred(fn, *args)
+        if GTFSSession.parse_pool is None:
+            # twisted's logging replaces sys.stderr with an object without a file descriptor, the resource tracker
+            # started along with the pool hands sys.stderr down to its process
+            stderr, sys.stderr = sys.stderr, sys.__stderr__
+            try:
+                resource_tracker.ensure_running()
+            finally:
+                sys.stderr = stderr
+            # the reactor's threadpool is already running, forking it could deadlock the workers
+            GTFSSession.parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                                         mp_context=multiprocessing.get_context("forkserver"))
+            reactor.addSystemEventTrigger("before", "shutdown", self.shutdown_parse_pool)
+
+        d = Deferred()
+
+        def done(future):
+            if future.exception():
+                reactor.callFromThread(d.errback, future.exception())
+            else:
+                reactor.callFromThread(d.callback, future.result())
+
+        self.parse_pool.submit(fn, *args).add_done_callback(done)
+        return d
+
+    @staticmethod
+    def shutdown_parse_pool():
+        if GTFSSession.parse_pool is not None:
+            GTFSSession.parse_pool.shutdown(wait=False, cancel_futures=True)
+            GTFSSession.parse_pool = None
+
+    @inlineCallbacks
     def parse_bundle(self, config_id: str):
+        """Parse the bundle into GTFSResults, when results exist only the files whose content changed are parsed
+
+        Every file is parsed in its own worker process, the reactor only waits on the results.
+        """
+        config = self.gtfs_configs[config_id]
         try:
-            kwargs = {"timestamp": datetime.datetime.now()}
-            for file in os.listdir(f"cache/{config_id}/bundle"):
+            previous = self.gtfs_results.get(config_id)
+            table_digests = yield threads.deferToThread(ingest.table_digests, config_id, config.ingest_from_zip)
+            digest = yield threads.deferToThread(ingest.bundle_digest, config_id)
+            stats = ingest.IngestStats(config_id=config_id)
+            kwargs = {"timestamp": datetime.datetime.now(), "digest": digest, "table_digests": table_digests}
+
+            pending = []
+            for file in ingest.list_bundle_files(config_id, from_zip=config.ingest_from_zip):
                 file_pre = file.replace('.txt', '')
                 if file_pre not in [i.name for i in GTFSParsers]:
                     self.log.info(f"{file_pre} was not found in our parser list, may be a gtfs+/experimental entity")
                     continue
-                kwargs[file_pre] = []
-                with open(f"cache/{config_id}/bundle/{file}", 'r') as file_handle:
-                    csvreader = list(csv.reader(file_handle))
-                    header = csvreader[0]
-                    for row in csvreader[1:]:
-                        kwargs[file_pre].append(getattr(GTFSParsers, file_pre).value(**dict(zip(header, row))))
+                if previous and previous.table_digests.get(file_pre) == table_digests.get(file_pre):
+                    continue
+                pending.append(self.run_parser(ingest.parse_file, config_id, file,
+                                               getattr(GTFSParsers, file_pre).value, config.ingest_from_zip))
+
+            tables = {}
+            for parsed, table_stats in (yield gatherResults(pending, consumeErrors=True)):
+                tables.update(parsed)
+                stats.add(table_stats)
+                self.log.debug(str(table_stats))
+            yield threads.deferToThread(ingest.intern_tables, tables)
+            if self.config_changed(config_id, config):
+                self.log.info(f"{config_id} was removed or pointed at another feed while parsing, dropping the results")
+                return
+
+            if previous:
+                # optional files that vanished from the feed
+                for name in set(previous.table_digests) - set(table_digests):
+                    tables[name] = None
+                self.gtfs_results[config_id] = previous.with_tables(**tables, **kwargs)
+                self.log.info(f"Re-parsed {[i.name for i in stats.tables] or 'nothing'} of {config_id}")
+            else:
+                self.gtfs_results[config_id] = GTFSResults(**tables, **kwargs)
+            self.departure_cache.invalidate(config_id)
+            self.log.info(f"Completed Ingesting {stats.summary()}")
+            self.enforce_memory_budget()
+            yield threads.deferToThread(snapshot.write_snapshot, config_id, self.gtfs_results[config_id], digest)
 
-            self.gtfs_results[config_id] = GTFSResults(**kwargs)
-            self.log.info(f"Completed Ingesting {config_id}")
+        except Exception as e:
+            import traceback
+            self.log.error(str(e))
+            self.log.error(traceback.format_exc())
 
+    @inlineCallbacks
+    def load_snapshot(self, config_id: str) -> bool:
+        """Restore the results of the bundle already on disk, if it was snapshotted after parsing"""
+        config = self.gtfs_configs[config_id]
+        digest = yield threads.deferToThread(ingest.bundle_digest, config_id)
+        if not digest or self.config_changed(config_id, config):
+            return False
+        try:
+            start = datetime.datetime.now()
+            results = snapshot.load_snapshot(config_id, GTFSResults, digest)
         except Exception as e:
-            self.log.error(e)
+            self.log.error(f"Could not load the snapshot for {config_id}: {e}")
+            return False
+        if not results:
+            return False
+        self.gtfs_results[config_id] = results
+        self.departure_cache.invalidate(config_id)
+        self.enforce_memory_budget()
+        self.log.info(f"Loaded {config_id} from snapshot in {(datetime.datetime.now() - start).total_seconds():.2f}s")
+        return True
+
+    def bundle_is_fresh(self, config_id: str) -> bool:
+        """Whether the bundle was checked against the server within gtfs_ttl_days"""
+        ttl = self.gtfs_configs[config_id].gtfs_ttl_days * 86400
+        return time.time() - ingest.read_bundle_meta(config_id).checked < ttl
 
     @inlineCallbacks
     def do_update(self, config_id: str):
-        self.log.info(f"Updating {config_id}")
+        config = self.gtfs_configs[config_id]
         self.assert_directory_structure(config_id)
+        if config_id not in self.gtfs_results:
+            yield self.load_snapshot(config_id)
+        current = self.gtfs_results.get(config_id)
+        if current and self.bundle_is_fresh(config_id):
+            return
+
+        self.log.info(f"Updating {config_id}")
         yield self.download_and_write(config_id)
-        self.unzip_bundle(config_id)
-        self.parse_bundle(config_id)
+        if self.config_changed(config_id, config):
+            return
+        if current and current.digest == ingest.read_bundle_meta(config_id).digest:
+            self.log.info(f"{config_id} bundle is unchanged, skipping parse")
+            return
+        if not os.path.isfile(f"cache/{config_id}/bundle.zip"):
+            return
+        if not config.ingest_from_zip:
+            yield threads.deferToThread(self.unzip_bundle, config_id)
+        yield self.parse_bundle(config_id)
+
+    @inlineCallbacks
+    def guarded_update(self, config_id: str):
+        """do_update, skipped while a previous update of the same config is still running"""
+        if config_id in self.gtfs_updating:
+            return
+        self.gtfs_updating.add(config_id)
+        try:
+            yield self.do_update(config_id)
+        except Exception:
+            self.log.failure(f"Updating {config_id} failed")
+        finally:
+            self.gtfs_updating.discard(config_id)
 
     def ticker_update_gtfs(self):
-        uninstantiated_results = set(self.gtfs_configs.keys()) - set(self.gtfs_results.keys())
-        for ur in uninstantiated_results:
-            self.do_update(ur)
+        for config_id in list(self.gtfs_configs.keys()):
+            self.guarded_update(config_id)
 
-        # todo handle configs being removed
+    @inlineCallbacks
+    def do_update_gtfs_rt(self, config_id: str, feed: GTFSRTEnum):
+        try:
+            results = self.gtfs_results.get(config_id)
+            payload = yield realtime.retrieve_feed(self.gtfs_configs[config_id].gtfsrt_urls[feed])
+            if not payload or not results:
+                return
+            message = realtime.parse_feed(payload)
+            if feed == GTFSRTEnum.TRIP_UPDATES:
+                changed = results.realtime.apply_trip_updates(message, results.resolve_stop_time)
+            elif feed == GTFSRTEnum.VEHICLE_POSITIONS:
+                changed = results.realtime.apply_vehicle_positions(message)
+            else:
+                self.log.debug(f"{feed.value} is not handled yet")
+                return
+            if changed and feed == GTFSRTEnum.TRIP_UPDATES:
+                self.departure_cache.invalidate(config_id)
+            self.log.info(f"{config_id} {feed.value}: {len(changed)} changed of {len(message.entity)}")
+        except Exception as e:
+            import traceback
+            self.log.error(e)
+            self.log.error(traceback.format_exc())
 
     def ticker_update_gtfs_rt(self):
-        pass
+        now = time.time()
+        for config_id, config in self.gtfs_configs.items():
+            if config_id not in self.gtfs_results:
+                continue
+            for feed in config.gtfsrt_urls:
+                if now - self.gtfsrt_fetched.get((config_id, feed), 0) < config.gtfsrt_ttl_seconds:
+                    continue
+                self.gtfsrt_fetched[(config_id, feed)] = now
+                self.do_update_gtfs_rt(config_id, feed)
 
     def gtfs_herald(self):
         """ Herald line data (wip)"""
         try:
             for i in self.gtfs_results:
                 config = self.gtfs_configs[i]
+                results = self.gtfs_results[i]
+                now = datetime.datetime.now(tz=pytz.timezone(config.transit_system_tz))
                 for stop in config.relevant_stops:
                     self.log.debug(f"heralding {i} - {stop}")
-                    self.gtfs_results[i].get_next_schedules_for_stop(stop)
+                    upcoming = self.departure_cache.get(i, results, stop, now)
+                    trips = results._get_trips_by_id([t.trip_id for t in upcoming])
+                    self.log.info("Upcoming")
+                    for t in upcoming:
+                        self.log.info(
+                            f"Line {trips[t.trip_id].route_id} Arrives at {t.arrival_time} {t.arrival_time_as_delta_seconds(now)} ")
             if not self.gtfs_results:
                 self.log.info("Herald: No data has been loaded, chilling")
         except Exception as e:
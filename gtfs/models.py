@@ -39,6 +39,7 @@ class RouteType(IntEnum):
 class Pickup(IntEnum):
     NONE = -1
     CONTINUOUS = 0
+    NOT_AVAILABLE = 1
     PHONE_AGENCY = 2
     COORDINATE_DRIVER = 3
 
@@ -79,6 +80,8 @@ class TransferType(IntEnum):
     TIMED = 1
     MINIMUM_TIME = 2
     NOT_POSSIBLE = 3
+    IN_SEAT = 4
+    NO_IN_SEAT = 5
 
 
 class PathwayMode(IntEnum):
@@ -88,6 +91,7 @@ class PathwayMode(IntEnum):
     ESCALATOR = 4
     ELEVATOR = 5
     FAREGATE = 6
+    EXIT_GATE = 7
 
 
 class BiDirectionality(IntEnum):
@@ -137,15 +141,15 @@ class Stop:
 
     stop_code: Optional[str] = None
     stop_desc: Optional[str] = None
-    stop_lat: Optional[str] = None
-    stop_lon: Optional[str] = None
-    zone_id: Optional[int] = None
+    stop_lat: Optional[float] = None
+    stop_lon: Optional[float] = None
+    zone_id: Optional[str] = None
     stop_url: Optional[str] = None
     location_type: Optional[LocationType] = None
-    parent_station: Optional[int] = None
+    parent_station: Optional[str] = None
     stop_timezone: Optional[str] = None
     wheelchair_boarding: Optional[AccessibilityEnum] = None
-    level_id: Optional[int] = None
+    level_id: Optional[str] = None
     platform_code: Optional[str] = None
     platform_name: Optional[str] = None  # gtfs-exp
     stop_address: Optional[str] = None  # gtfs-exp
@@ -160,7 +164,7 @@ class Route:
     route_id: str
     route_type: RouteType
 
-    agency_id: Optional[int] = None
+    agency_id: Optional[str] = None
     route_short_name: Optional[str] = None
     route_long_name: Optional[str] = None
     route_desc: Optional[str] = None
@@ -185,7 +189,7 @@ class Trip:
     trip_short_name: Optional[str] = None
     direction_id: Optional[int] = None
     block_id: Optional[str] = None
-    shape_id: Optional[int] = None
+    shape_id: Optional[str] = None
     wheelchair_accessible: Optional[AccessibilityEnum] = None
     bikes_allowed: Optional[AccessibilityEnum] = None
 
@@ -237,7 +241,7 @@ class Calendar:
 
 @dataclass
 class CalendarDate:
-    service_id: int
+    service_id: str
     date: str
     exception_type: CalendarException
     holiday_name: str  # gtfs-exp
@@ -0,0 +1,202 @@
+import bisect
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import treq
+from google.transit import gtfs_realtime_pb2
+from twisted.internet import threads
+from twisted.internet.defer import inlineCallbacks
+
+# (trip_id, stop_sequence or None, stop_id or None, service date "YYYYMMDD" or None) ->
+# (stop_sequence, scheduled unix time) of the matching static stop time
+StopResolver = Callable[[str, Optional[int], Optional[str], Optional[str]], Optional[Tuple[int, int]]]
+
+SKIPPED = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+CANCELED = gtfs_realtime_pb2.TripDescriptor.CANCELED
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as source:
+        return source.read()
+
+
+@inlineCallbacks
+def retrieve_feed(url: str, kwargs: Dict = {}) -> Optional[bytes]:
+    """Fetch a protobuf payload over http, or from disk for file:// urls and plain paths (fixtures)"""
+    parsed = urlparse(url)
+    if parsed.scheme in ("", "file"):
+        path = parsed.path if parsed.scheme else url
+        if not os.path.isfile(path):
+            return None
+        payload = yield threads.deferToThread(_read_file, path)
+        return payload
+    response = yield treq.get(url, **kwargs)
+    if response.code in [200, 201, 202]:
+        payload = yield treq.content(response)
+        return payload
+
+
+def parse_feed(payload: bytes) -> gtfs_realtime_pb2.FeedMessage:
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(payload)
+    return message
+
+
+class TripPrediction:
+    """Live delays of one trip, propagated downstream from each update as the gtfs-rt spec describes"""
+    __slots__ = ("cancelled", "sequences", "delays", "skipped", "stop_delays")
+
+    def __init__(self, cancelled: bool = False):
+        self.cancelled = cancelled
+        self.sequences: List[int] = []
+        self.delays: List[int] = []
+        self.skipped: Set[int] = set()
+        self.stop_delays: Dict[str, int] = {}  # updates that only carry a stop_id apply to that stop only
+
+    def __eq__(self, other):
+        return isinstance(other, TripPrediction) and all(
+            getattr(self, i) == getattr(other, i) for i in self.__slots__)
+
+    def delay_for(self, stop_sequence: Optional[int], stop_id: Optional[str] = None) -> Optional[int]:
+        """Delay in seconds at a stop, None if the stop (or the whole trip) won't be served"""
+        if self.cancelled or stop_sequence in self.skipped:
+            return None
+        if stop_id in self.stop_delays:
+            return self.stop_delays[stop_id]
+        idx = bisect.bisect_right(self.sequences, stop_sequence if stop_sequence is not None else -1) - 1
+        if idx < 0:
+            return 0
+        return self.delays[idx]
+
+    def delays_known(self) -> List[int]:
+        return self.delays + list(self.stop_delays.values())
+
+
+@dataclass
+class VehiclePosition:
+    vehicle_id: str
+    trip_id: str
+    latitude: float
+    longitude: float
+    bearing: Optional[float] = None
+    stop_id: Optional[str] = None
+    current_status: Optional[int] = None
+    timestamp: Optional[int] = None
+
+
+class RealtimeState:
+    """The live overlay on top of a static GTFSResults, each feed only replaces the trips it changed"""
+
+    def __init__(self):
+        self.trips: Dict[str, TripPrediction] = {}
+        self.vehicles: Dict[str, VehiclePosition] = {}
+        self.version = 0  # bumped whenever predictions change, for anyone caching query results
+        self.latest = 0  # bounds of the known delays, so static windows can be widened to catch shifted trips
+        self.earliest = 0
+
+    def delay_for(self, trip_id: str, stop_sequence: Optional[int], stop_id: Optional[str] = None) -> Optional[int]:
+        prediction = self.trips.get(trip_id)
+        if prediction is None:
+            return 0
+        return prediction.delay_for(stop_sequence, stop_id)
+
+    def _build_prediction(self, trip_update, resolve: StopResolver) -> TripPrediction:
+        trip = trip_update.trip
+        prediction = TripPrediction(cancelled=trip.schedule_relationship == CANCELED)
+        start_date = trip.start_date or None
+        updates = []
+        for stu in trip_update.stop_time_update:
+            sequence = stu.stop_sequence if stu.HasField("stop_sequence") else None
+            stop_id = stu.stop_id or None
+            if stu.schedule_relationship == SKIPPED:
+                if sequence is None and stop_id:
+                    resolved = resolve(trip.trip_id, None, stop_id, start_date)
+                    sequence = resolved[0] if resolved else None
+                if sequence is not None:
+                    prediction.skipped.add(sequence)
+                continue
+
+            event = stu.arrival if stu.HasField("arrival") else stu.departure
+            if event.HasField("delay"):
+                delay = event.delay
+            elif event.HasField("time"):
+                resolved = resolve(trip.trip_id, sequence, stop_id, start_date)
+                if not resolved:
+                    continue
+                sequence, scheduled = resolved
+                delay = event.time - scheduled
+            else:
+                delay = None  # NO_DATA, stops from here on run to schedule
+
+            if sequence is None:
+                if stop_id and delay is not None:
+                    prediction.stop_delays[stop_id] = delay
+                continue
+            updates.append((sequence, delay))
+
+        if not updates and trip_update.HasField("delay"):
+            updates.append((-1, trip_update.delay))
+        for sequence, delay in sorted(updates, key=lambda x: x[0]):
+            prediction.sequences.append(sequence)
+            prediction.delays.append(delay if delay is not None else 0)
+        return prediction
+
+    def apply_trip_updates(self, message: gtfs_realtime_pb2.FeedMessage, resolve: StopResolver) -> Set[str]:
+        """Apply a TripUpdates feed, returning the trip_ids whose prediction changed"""
+        seen = set()
+        changed = set()
+        for entity in message.entity:
+            if not entity.HasField("trip_update"):
+                continue
+            trip_id = entity.trip_update.trip.trip_id
+            if not trip_id:
+                continue
+            seen.add(trip_id)
+            prediction = self._build_prediction(entity.trip_update, resolve)
+            if self.trips.get(trip_id) != prediction:
+                self.trips[trip_id] = prediction
+                changed.add(trip_id)
+
+        if message.header.incrementality == gtfs_realtime_pb2.FeedHeader.FULL_DATASET:
+            for trip_id in set(self.trips) - seen:
+                del self.trips[trip_id]
+                changed.add(trip_id)
+
+        if changed:
+            self.version += 1
+            delays = [d for i in self.trips.values() for d in i.delays_known()]
+            self.latest = max([0] + delays)
+            self.earliest = min([0] + delays)
+        return changed
+
+    def apply_vehicle_positions(self, message: gtfs_realtime_pb2.FeedMessage) -> Set[str]:
+        """Apply a VehiclePositions feed, returning the vehicle ids that moved"""
+        seen = set()
+        changed = set()
+        for entity in message.entity:
+            if not entity.HasField("vehicle"):
+                continue
+            vehicle = entity.vehicle
+            vehicle_id = vehicle.vehicle.id or entity.id
+            seen.add(vehicle_id)
+            position = VehiclePosition(
+                vehicle_id=vehicle_id,
+                trip_id=vehicle.trip.trip_id,
+                latitude=vehicle.position.latitude,
+                longitude=vehicle.position.longitude,
+                bearing=vehicle.position.bearing if vehicle.position.HasField("bearing") else None,
+                stop_id=vehicle.stop_id or None,
+                current_status=vehicle.current_status if vehicle.HasField("current_status") else None,
+                timestamp=vehicle.timestamp or None,
+            )
+            if self.vehicles.get(vehicle_id) != position:
+                self.vehicles[vehicle_id] = position
+                changed.add(vehicle_id)
+
+        if message.header.incrementality == gtfs_realtime_pb2.FeedHeader.FULL_DATASET:
+            for vehicle_id in set(self.vehicles) - seen:
+                del self.vehicles[vehicle_id]
+                changed.add(vehicle_id)
+        return changed
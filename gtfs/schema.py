@@ -0,0 +1,144 @@
+import csv
+import dataclasses
+import enum
+import functools
+import sys
+import typing
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Set, TextIO, Tuple
+
+import aenum
+
+CHUNK_ROWS = 8192
+
+
+@dataclass
+class CoercionStats:
+    invalid: Dict[str, int] = field(default_factory=dict)  # column -> values that didn't parse and became null
+    ignored: Set[str] = field(default_factory=set)  # columns the model doesn't know about
+    rows: int = 0  # csv rows read by the columnar tables, including rows they drop
+
+    def add_invalid(self, column: str, count: int):
+        if count:
+            self.invalid[column] = self.invalid.get(column, 0) + count
+
+    @property
+    def total_invalid(self) -> int:
+        return sum(self.invalid.values())
+
+
+class ColumnType:
+    """Parses a whole column of raw csv strings at once, empty strings become `null`"""
+
+    def __init__(self, parse: Callable[[str], Any]):
+        self.parse = parse
+
+    def convert(self, values: Sequence[str], null: Any = None) -> Tuple[List[Any], int]:
+        """(parsed values, number of invalid values)"""
+        parse = self.parse
+        try:
+            return [parse(v) if v else null for v in values], 0
+        except (ValueError, KeyError, TypeError):
+            pass
+
+        # slow path, only taken by columns that actually hold bad values
+        converted = []
+        invalid = 0
+        for v in values:
+            try:
+                converted.append(parse(v) if v else null)
+            except (ValueError, KeyError, TypeError):
+                converted.append(null)
+                invalid += 1
+        return converted, invalid
+
+
+def _unwrap_optional(annotation):
+    if typing.get_origin(annotation) is typing.Union:
+        args = [i for i in typing.get_args(annotation) if i is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+@functools.lru_cache(maxsize=None)
+def enum_lookup(enum_cls) -> Dict[str, Any]:
+    """raw csv value -> enum member, built once per enum so rows don't construct members"""
+    return {str(member.value): member for member in enum_cls.__members__.values()}
+
+
+@functools.lru_cache(maxsize=None)
+def column_type(annotation, raw_enums: bool = False) -> ColumnType:
+    """ColumnType for a declared field type, raw_enums parses enums to their plain values for typed arrays"""
+    annotation = _unwrap_optional(annotation)
+    if isinstance(annotation, type) and issubclass(annotation, (enum.Enum, aenum.Enum)):
+        lookup = enum_lookup(annotation)
+        if raw_enums:
+            lookup = {k: v.value for k, v in lookup.items()}
+        return ColumnType(lookup.__getitem__)
+    if annotation is int:
+        return ColumnType(int)
+    if annotation is float:
+        return ColumnType(float)
+    # interned so repeats within a table share one object, which pickling out of the worker preserves
+    return ColumnType(sys.intern)
+
+
+@functools.lru_cache(maxsize=None)
+def schema_for(model) -> List[Tuple[str, ColumnType]]:
+    """(field name, ColumnType) in the model's field order"""
+    hints = typing.get_type_hints(model)
+    return [(i.name, column_type(hints[i.name])) for i in dataclasses.fields(model)]
+
+
+def iter_chunks(file_handle: TextIO, chunk_rows: int = CHUNK_ROWS) -> Iterator[Dict[str, Sequence[str]]]:
+    """Read a csv in chunks of rows, yielding each chunk transposed to header -> column values"""
+    csvreader = csv.reader(file_handle)
+    header = next(csvreader, None)
+    if not header:
+        return
+    header = [i.strip() for i in header]
+    width = len(header)
+
+    chunk = []
+    for row in csvreader:
+        if len(row) != width:
+            if not row:
+                continue
+            row = (row + [''] * width)[:width]
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield dict(zip(header, zip(*chunk)))
+            chunk = []
+    if chunk:
+        yield dict(zip(header, zip(*chunk)))
+
+
+def iter_models(file_handle: TextIO, model, stats: CoercionStats) -> Iterator:
+    """Parse a csv into model instances, coercing each column to its declared type in one pass per chunk"""
+    schema = schema_for(model)
+    names = {name for name, _ in schema}
+    for columns in iter_chunks(file_handle):
+        rows = len(next(iter(columns.values())))
+        stats.ignored.update(set(columns) - names)
+        converted = []
+        for name, ctype in schema:
+            values = columns.get(name)
+            if values is None:
+                converted.append([None] * rows)
+                continue
+            parsed, invalid = ctype.convert(values)
+            stats.add_invalid(name, invalid)
+            converted.append(parsed)
+        for values in zip(*converted):
+            yield model(*values)
+
+
+def intern_rows(rows: Sequence[Any]) -> None:
+    """Swap the string fields of rows for their process wide interned copy, so feeds share headsigns, names, tzs"""
+    intern = sys.intern
+    for row in rows:
+        values = row.__dict__
+        for name, value in values.items():
+            if type(value) is str:
+                values[name] = intern(value)
@@ -0,0 +1,72 @@
+import datetime
+from typing import Dict, Iterable, List, Optional
+
+import models
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+def parse_gtfs_date(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, "%Y%m%d").date()
+
+
+class ServiceCalendar:
+    """service_id -> bitmap of the dates it runs on, bit n meaning epoch + n days
+
+    Built from calendar.txt weekday flags, then calendar_dates.txt exceptions are applied on top.
+    """
+
+    def __init__(self, calendar: Optional[List[models.Calendar]], calendar_dates: Optional[List[models.CalendarDate]]):
+        calendar = calendar or []
+        calendar_dates = calendar_dates or []
+        # feeds without any service information run everything every day
+        self.unrestricted = not calendar and not calendar_dates
+        self.bitmaps: Dict[str, bytearray] = {}
+        if self.unrestricted:
+            self.epoch = datetime.date.min
+            self.days = 0
+            return
+
+        ranges = [(i, parse_gtfs_date(i.start_date), parse_gtfs_date(i.end_date)) for i in calendar]
+        exceptions = [(i, parse_gtfs_date(i.date)) for i in calendar_dates]
+        dates = [d for _, start, end in ranges for d in (start, end)] + [d for _, d in exceptions]
+        self.epoch = min(dates)
+        self.days = (max(dates) - self.epoch).days + 1
+
+        for row, start, end in ranges:
+            flags = [getattr(row, day) == models.CalendarDay.AVAILABLE for day in WEEKDAYS]
+            bitmap = self._bitmap(row.service_id)
+            for offset in range((start - self.epoch).days, (end - self.epoch).days + 1):
+                if flags[(self.epoch + datetime.timedelta(days=offset)).weekday()]:
+                    bitmap[offset >> 3] |= 1 << (offset & 7)
+
+        for row, date in exceptions:
+            bitmap = self._bitmap(row.service_id)
+            offset = (date - self.epoch).days
+            if row.exception_type == models.CalendarException.ADDED:
+                bitmap[offset >> 3] |= 1 << (offset & 7)
+            else:
+                bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+    def _bitmap(self, service_id: str) -> bytearray:
+        if service_id not in self.bitmaps:
+            self.bitmaps[service_id] = bytearray((self.days + 7) >> 3)
+        return self.bitmaps[service_id]
+
+    def is_service_active(self, service_id: str, date: datetime.date) -> bool:
+        if self.unrestricted:
+            return True
+        bitmap = self.bitmaps.get(service_id)
+        offset = (date - self.epoch).days
+        if bitmap is None or not 0 <= offset < self.days:
+            return False
+        return bool(bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def active_services(self, service_ids: Iterable[str], date: datetime.date) -> List[str]:
+        return [i for i in service_ids if self.is_service_active(i, date)]
+
+
+def service_day_start(date: datetime.date, tz: datetime.tzinfo) -> datetime.datetime:
+    """gtfs times count from noon minus 12h, which is midnight except on daylight saving changes"""
+    noon = tz.localize(datetime.datetime.combine(date, datetime.time(12)))
+    return noon - datetime.timedelta(hours=12)
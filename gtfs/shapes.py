@@ -0,0 +1,147 @@
+import math
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from schema import CoercionStats, column_type, iter_chunks
+
+EARTH_RADIUS_M = 6371008.8
+SIMPLIFIED_CACHE_SIZE = 256  # decimated polylines kept, least recently used go first
+
+Point = Tuple[float, float]  # (lat, lon)
+
+
+def _douglas_peucker(points: List[Point], tolerance_m: float) -> List[Point]:
+    """Drop points closer than tolerance_m to the line between their kept neighbours, iterative to spare the stack"""
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+
+    # equirectangular projection around the shape, plenty accurate at city scale
+    lat0 = math.radians(sum(p[0] for p in points) / len(points))
+    kx = math.radians(1) * EARTH_RADIUS_M * math.cos(lat0)
+    ky = math.radians(1) * EARTH_RADIUS_M
+    xy = [(lon * kx, lat * ky) for lat, lon in points]
+
+    keep = bytearray(len(points))
+    keep[0] = keep[-1] = 1
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xy[first]
+        bx, by = xy[last]
+        dx, dy = bx - ax, by - ay
+        length = math.hypot(dx, dy)
+        worst, worst_idx = 0., 0
+        for idx in range(first + 1, last):
+            px, py = xy[idx]
+            if length:
+                distance = abs(dy * px - dx * py + bx * ay - by * ax) / length
+            else:
+                distance = math.hypot(px - ax, py - ay)
+            if distance > worst:
+                worst, worst_idx = distance, idx
+        if worst > tolerance_m:
+            keep[worst_idx] = 1
+            stack.append((first, worst_idx))
+            stack.append((worst_idx, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+class ShapeStore:
+    """shapes.txt grouped per shape_id into contiguous float32 coordinate arrays, ordered by shape_pt_sequence
+
+    points of shape i live in [offsets[i], offsets[i + 1]) of lats/lons/dists
+    """
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.offsets = array('i', [0])
+        self.lats = array('f')
+        self.lons = array('f')
+        self.dists = array('f')  # shape_dist_traveled, nan when missing
+        self._simplified: 'OrderedDict[Tuple[str, float], List[Point]]' = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_simplified"] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, shape_id: str) -> bool:
+        return shape_id in self.index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    @classmethod
+    def from_csv(cls, file_handle: TextIO, coercion: Optional[CoercionStats] = None) -> 'ShapeStore':
+        """Stream shapes.txt into per-shape arrays, no per-point objects are created"""
+        coercion = coercion if coercion is not None else CoercionStats()
+        floats = column_type(float)
+        ints = column_type(int)
+
+        shape_ids: List[str] = []
+        sequences = array('i')
+        lats, lons, dists = array('f'), array('f'), array('f')
+        for columns in iter_chunks(file_handle):
+            rows = len(next(iter(columns.values())))
+            coercion.rows += rows
+            coercion.ignored.update(set(columns) - {"shape_id", "shape_pt_lat", "shape_pt_lon",
+                                                    "shape_pt_sequence", "shape_dist_traveled"})
+            shape_ids.extend(columns.get("shape_id", [""] * rows))
+            for name, ctype, target, null in (("shape_pt_sequence", ints, sequences, 0),
+                                              ("shape_pt_lat", floats, lats, math.nan),
+                                              ("shape_pt_lon", floats, lons, math.nan),
+                                              ("shape_dist_traveled", floats, dists, math.nan)):
+                converted, invalid = ctype.convert(columns.get(name, [""] * rows), null)
+                coercion.add_invalid(name, invalid)
+                target.extend(converted)
+
+        store = cls()
+        order = sorted((row for row in range(len(shape_ids))
+                        if shape_ids[row] and not math.isnan(lats[row]) and not math.isnan(lons[row])),
+                       key=lambda row: (shape_ids[row], sequences[row]))
+        for row in order:
+            shape_id = shape_ids[row]
+            if shape_id not in store.index:
+                if store.ids:
+                    store.offsets.append(len(store.lats))
+                store.index[shape_id] = len(store.ids)
+                store.ids.append(shape_id)
+            store.lats.append(lats[row])
+            store.lons.append(lons[row])
+            store.dists.append(dists[row])
+        if store.ids:
+            store.offsets.append(len(store.lats))
+        return store
+
+    def _bounds(self, shape_id: str) -> Tuple[int, int]:
+        idx = self.index.get(shape_id)
+        if idx is None:
+            return 0, 0
+        return self.offsets[idx], self.offsets[idx + 1]
+
+    def polyline(self, shape_id: str) -> List[Point]:
+        lo, hi = self._bounds(shape_id)
+        return list(zip(self.lats[lo:hi], self.lons[lo:hi]))
+
+    def simplified(self, shape_id: str, tolerance_m: float) -> List[Point]:
+        """The shape decimated to within tolerance_m meters (to the decimeter) of the full polyline, LRU cached"""
+        key = (shape_id, round(tolerance_m, 1))
+        simplified = self._simplified.get(key)
+        if simplified is None:
+            simplified = self._simplified[key] = _douglas_peucker(self.polyline(shape_id), key[1])
+            while len(self._simplified) > SIMPLIFIED_CACHE_SIZE:
+                self._simplified.popitem(last=False)
+        self._simplified.move_to_end(key)
+        return simplified
+
+    def clear_cache(self):
+        self._simplified.clear()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(col.itemsize * len(col) for col in (self.offsets, self.lats, self.lons, self.dists))
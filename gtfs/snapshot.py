@@ -0,0 +1,110 @@
+import dataclasses
+import datetime
+import json
+import mmap
+import os
+import pickle
+import sys
+from array import array
+from typing import Any, Dict, Optional, Type
+
+from schema import intern_rows
+from tables import StopIndex, StopTimeTable, TripIndex
+
+# bump when the on-disk layout or any pickled model changes shape
+SNAPSHOT_VERSION = 5
+
+COLUMNAR_FIELDS = ("stop_times", "stop_index", "trip_index")
+INDEX_ARRAYS = ("rows", "arrivals", "offsets")
+TRIP_INDEX_ARRAYS = ("rows", "offsets")
+
+
+def snapshot_dir(config_id: str) -> str:
+    return f"cache/{config_id}/snapshot"
+
+
+def _write_atomic(path: str, data) -> None:
+    # replace rather than truncate so a previous snapshot that's still mmapped keeps its pages
+    with open(path + ".tmp", 'wb') as destination:
+        destination.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _map_column(path: str, typecode: str):
+    """Map a column file read-only, falling back to an empty array as empty files can't be mmapped"""
+    if not os.path.getsize(path):
+        return array(typecode)
+    with open(path, 'rb') as source:
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+def snapshot_nbytes(config_id: str) -> int:
+    """Size of the snapshot on disk, close to what its results take in memory"""
+    directory = snapshot_dir(config_id)
+    if not os.path.isdir(directory):
+        return 0
+    return sum(os.path.getsize(f"{directory}/{i}") for i in os.listdir(directory))
+
+
+def read_meta(config_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(f"{snapshot_dir(config_id)}/meta.json", 'r') as source:
+            meta = json.load(source)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != SNAPSHOT_VERSION or meta.get("byteorder") != sys.byteorder:
+        return None
+    return meta
+
+
+def write_snapshot(config_id: str, results: Any, digest: str) -> None:
+    """Persist parsed results: stop_times columns and the stop/trip indexes as raw arrays, everything else pickled"""
+    directory = snapshot_dir(config_id)
+    os.makedirs(directory, exist_ok=True)
+
+    table: StopTimeTable = results.stop_times
+    for name, column in table.columns.items():
+        _write_atomic(f"{directory}/stop_times.{name}.bin", column)
+    for name in INDEX_ARRAYS:
+        _write_atomic(f"{directory}/stop_index.{name}.bin", getattr(results.stop_index, name))
+    for name in TRIP_INDEX_ARRAYS:
+        _write_atomic(f"{directory}/trip_index.{name}.bin", getattr(results.trip_index, name))
+
+    tables = {i.name: getattr(results, i.name) for i in dataclasses.fields(results)
+              if i.init and i.name not in COLUMNAR_FIELDS}
+    tables["pool"] = table.pool
+    _write_atomic(f"{directory}/tables.pickle", pickle.dumps(tables, protocol=pickle.HIGHEST_PROTOCOL))
+
+    feed_info = results.feed_info or []
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "byteorder": sys.byteorder,
+        "digest": digest,
+        "feed_version": feed_info[0].feed_version if feed_info else None,
+        "created": datetime.datetime.now().isoformat(),
+    }
+    _write_atomic(f"{directory}/meta.json", json.dumps(meta).encode())
+
+
+def load_snapshot(config_id: str, results_cls: Type, digest: str) -> Optional[Any]:
+    """Load the snapshot for a config if it was taken from the bundle with this digest"""
+    meta = read_meta(config_id)
+    if not meta or meta["digest"] != digest:
+        return None
+
+    directory = snapshot_dir(config_id)
+    with open(f"{directory}/tables.pickle", 'rb') as source:
+        tables = pickle.load(source)
+    for value in tables.values():
+        if isinstance(value, list):
+            intern_rows(value)
+
+    table = StopTimeTable(tables.pop("pool"))
+    table.columns = {name: _map_column(f"{directory}/stop_times.{name}.bin", typecode)
+                     for name, (typecode, _) in StopTimeTable.COLUMNS.items()}
+    stop_index = StopIndex.from_arrays(table, *[
+        _map_column(f"{directory}/stop_index.{name}.bin", 'i') for name in INDEX_ARRAYS])
+    trip_index = TripIndex.from_arrays(table, *[
+        _map_column(f"{directory}/trip_index.{name}.bin", 'i') for name in TRIP_INDEX_ARRAYS])
+    return results_cls(stop_times=table, stop_index=stop_index, trip_index=trip_index, **tables)
@@ -0,0 +1,319 @@
+import bisect
+import math
+import sys
+import typing
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, TextIO, Tuple
+
+import models
+from schema import CoercionStats, ColumnType, column_type, enum_lookup, iter_chunks
+
+NULL = -1  # missing codes / times / ints
+SMALL_NULL = -128  # missing enum values, Pickup.NONE is already -1
+
+
+def gtfs_time_to_seconds(value: str) -> int:
+    """'25:10:00' -> 90600 seconds since the start of the service day"""
+    if not value:
+        return NULL
+    h, m, s = value.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+def seconds_to_gtfs_time(value: int) -> Optional[str]:
+    if value == NULL:
+        return None
+    return f"{value // 3600:02d}:{value % 3600 // 60:02d}:{value % 60:02d}"
+
+
+class StringPool:
+    """Interns repeated strings (ids, headsigns) to integer codes"""
+
+    def __init__(self, strings: Optional[List[str]] = None):
+        self.strings: List[str] = strings or []
+        self.codes: Dict[str, int] = {s: i for i, s in enumerate(self.strings)}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getstate__(self):
+        return self.strings
+
+    def __setstate__(self, state):
+        # unpickling happens in the serving process, share the strings with every other feed there
+        self.__init__([sys.intern(i) for i in state])
+
+    def code(self, value: str) -> int:
+        """Get the code of a value, adding it to the pool if needed"""
+        if not value:
+            return NULL
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def lookup(self, value: str) -> int:
+        """Get the code of a value without adding it"""
+        return self.codes.get(value, NULL)
+
+    def get(self, code: int) -> Optional[str]:
+        return None if code == NULL else self.strings[code]
+
+    @property
+    def nbytes(self) -> int:
+        """Estimate from a sample of the strings, plus the list and the codes dict"""
+        if not self.strings:
+            return 0
+        sample = self.strings[::max(1, len(self.strings) // 64)]
+        per_string = sum(sys.getsizeof(i) for i in sample) / len(sample)
+        return int(len(self.strings) * per_string + sys.getsizeof(self.strings) + sys.getsizeof(self.codes))
+
+
+def _pooled(name):
+    return property(lambda self: self.table.pool.get(self.table.columns[name][self.row]))
+
+
+def _seconds(name):
+    def getter(self):
+        value = self.table.columns[name][self.row]
+        return None if value == NULL else value + self.shift
+    return property(getter)
+
+
+def _time(name):
+    def getter(self):
+        value = self.table.columns[name][self.row]
+        return None if value == NULL else seconds_to_gtfs_time(value + self.shift)
+    return property(getter)
+
+
+def _int(name, null=NULL):
+    def getter(self):
+        value = self.table.columns[name][self.row]
+        return None if value == null else value
+    return property(getter)
+
+
+def _enum(name, enum_cls):
+    members = {member.value: member for member in enum_lookup(enum_cls).values()}
+
+    def getter(self):
+        return members.get(self.table.columns[name][self.row])
+    return property(getter)
+
+
+def _float(name):
+    def getter(self):
+        value = self.table.columns[name][self.row]
+        return None if math.isnan(value) else value
+    return property(getter)
+
+
+class StopTimeView:
+    """A single row of a StopTimeTable, quacks like models.StopTime
+
+    shift moves the arrival/departure times, e.g. for one departure of a frequency based trip.
+    """
+    __slots__ = ("table", "row", "shift")
+
+    def __init__(self, table: 'StopTimeTable', row: int, shift: int = 0):
+        self.table = table
+        self.row = row
+        self.shift = shift
+
+    trip_id = _pooled("trip_id")
+    stop_id = _pooled("stop_id")
+    stop_sequence = _int("stop_sequence")
+    arrival_time = _time("arrival_time")
+    departure_time = _time("departure_time")
+    stop_headsign = _pooled("stop_headsign")
+    pickup_type = _enum("pickup_type", models.Pickup)
+    drop_off_type = _enum("drop_off_type", models.Pickup)
+    continuous_pickup = _enum("continuous_pickup", models.Pickup)
+    continuous_drop_off = _enum("continuous_drop_off", models.Pickup)
+    shape_dist_traveled = _float("shape_dist_traveled")
+    timepoint = _enum("timepoint", models.TimePoint)
+    checkpoint_id = _pooled("checkpoint_id")
+
+    arrival_seconds = _seconds("arrival_time")
+    departure_seconds = _seconds("departure_time")
+
+    arrival_time_as_delta_seconds = models.StopTime.arrival_time_as_delta_seconds
+
+    def __repr__(self):
+        return f"StopTimeView(row={self.row}, trip_id={self.trip_id!r}, stop_id={self.stop_id!r}, " \
+               f"arrival_time={self.arrival_time!r})"
+
+
+class StopTimeTable:
+    """Column-oriented store for stop_times.txt, ids are pooled and times kept as int32 seconds"""
+
+    # column -> (array typecode, parser kind)
+    COLUMNS = {
+        "trip_id": ("i", "pooled"),
+        "stop_id": ("i", "pooled"),
+        "stop_sequence": ("i", "int"),
+        "arrival_time": ("i", "time"),
+        "departure_time": ("i", "time"),
+        "stop_headsign": ("i", "pooled"),
+        "pickup_type": ("b", "small"),
+        "drop_off_type": ("b", "small"),
+        "continuous_pickup": ("b", "small"),
+        "continuous_drop_off": ("b", "small"),
+        "shape_dist_traveled": ("f", "float"),
+        "timepoint": ("b", "small"),
+        "checkpoint_id": ("i", "pooled"),
+    }
+    NULLS = {"pooled": NULL, "int": NULL, "time": NULL, "small": SMALL_NULL, "float": math.nan}
+
+    def __init__(self, pool: Optional[StringPool] = None):
+        self.pool = pool if pool is not None else StringPool()
+        self.columns: Dict[str, array] = {name: array(typecode) for name, (typecode, _) in self.COLUMNS.items()}
+
+    def __len__(self):
+        return len(self.columns["trip_id"])
+
+    def __getitem__(self, row: int) -> StopTimeView:
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return StopTimeView(self, row)
+
+    def __iter__(self) -> Iterator[StopTimeView]:
+        return (StopTimeView(self, row) for row in range(len(self)))
+
+    def _column_types(self) -> Dict[str, ColumnType]:
+        hints = typing.get_type_hints(models.StopTime)
+        types = {}
+        for name, (_, kind) in self.COLUMNS.items():
+            if kind == "pooled":
+                types[name] = ColumnType(self.pool.code)
+            elif kind == "time":
+                types[name] = ColumnType(gtfs_time_to_seconds)
+            else:
+                # enums are validated against the model's declared type and stored as their plain value
+                types[name] = column_type(hints[name], raw_enums=True)
+        return types
+
+    def _extend(self, columns: Dict[str, Sequence[str]], rows: int, types: Dict[str, ColumnType],
+                coercion: CoercionStats):
+        for name, (typecode, kind) in self.COLUMNS.items():
+            null = self.NULLS[kind]
+            values = columns.get(name)
+            if values is None:
+                self.columns[name].extend(array(typecode, [null]) * rows)
+                continue
+            converted, invalid = types[name].convert(values, null)
+            coercion.add_invalid(name, invalid)
+            self.columns[name].extend(array(typecode, converted))
+
+    @classmethod
+    def from_csv(cls, file_handle: TextIO, pool: Optional[StringPool] = None,
+                 coercion: Optional[CoercionStats] = None) -> 'StopTimeTable':
+        """Stream stop_times.txt straight into columns a chunk at a time, no per-row objects are created"""
+        table = cls(pool)
+        coercion = coercion if coercion is not None else CoercionStats()
+        types = table._column_types()
+        for columns in iter_chunks(file_handle):
+            rows = len(next(iter(columns.values())))
+            coercion.ignored.update(set(columns) - set(cls.COLUMNS))
+            coercion.rows += rows
+            table._extend(columns, rows, types, coercion)
+        return table
+
+    @property
+    def nbytes(self) -> int:
+        return sum(col.itemsize * len(col) for col in self.columns.values()) + self.pool.nbytes
+
+
+class StopIndex:
+    """Rows of a StopTimeTable grouped per stop and sorted by arrival, stored CSR style
+
+    rows/arrivals for stop code c live in [offsets[c], offsets[c + 1]) so a time window is two bisects
+    """
+
+    def __init__(self, table: StopTimeTable):
+        self.table = table
+        stops = table.columns["stop_id"]
+        arrivals = table.columns["arrival_time"]
+        departures = table.columns["departure_time"]
+
+        # rows without any time (untimed intermediate stops) can't be scheduled against
+        times = array('i', (a if a != NULL else d for a, d in zip(arrivals, departures)))
+        order = sorted((row for row in range(len(table)) if times[row] != NULL and stops[row] != NULL),
+                       key=lambda row: (stops[row], times[row]))
+
+        self.rows = array('i', order)
+        self.arrivals = array('i', (times[row] for row in order))
+        self.offsets = array('i', [0]) * (len(table.pool) + 1)
+        for row in order:
+            self.offsets[stops[row] + 1] += 1
+        for code in range(len(table.pool)):
+            self.offsets[code + 1] += self.offsets[code]
+
+    @classmethod
+    def from_arrays(cls, table: StopTimeTable, rows, arrivals, offsets) -> 'StopIndex':
+        """Rebuild from previously computed arrays (e.g. a snapshot) without sorting again"""
+        index = cls.__new__(cls)
+        index.table = table
+        index.rows, index.arrivals, index.offsets = rows, arrivals, offsets
+        return index
+
+    @property
+    def nbytes(self) -> int:
+        return sum(col.itemsize * len(col) for col in (self.rows, self.arrivals, self.offsets))
+
+    def _bounds(self, stop_id: str):
+        code = self.table.pool.lookup(stop_id)
+        if code == NULL or code + 1 >= len(self.offsets):
+            return 0, 0
+        return self.offsets[code], self.offsets[code + 1]
+
+    def rows_for_stop(self, stop_id: str) -> array:
+        lo, hi = self._bounds(stop_id)
+        return self.rows[lo:hi]
+
+    def window(self, stop_id: str, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        """(row, seconds) for a stop arriving strictly between start and end (seconds since the start of the service day)"""
+        lo, hi = self._bounds(stop_id)
+        first = bisect.bisect_right(self.arrivals, start, lo, hi)
+        last = bisect.bisect_left(self.arrivals, end, first, hi)
+        return zip(self.rows[first:last], self.arrivals[first:last])
+
+
+class TripIndex:
+    """Rows of a StopTimeTable grouped per trip and ordered by stop_sequence, stored like StopIndex"""
+
+    def __init__(self, table: StopTimeTable):
+        self.table = table
+        trips = table.columns["trip_id"]
+        sequences = table.columns["stop_sequence"]
+        order = sorted((row for row in range(len(table)) if trips[row] != NULL),
+                       key=lambda row: (trips[row], sequences[row]))
+
+        self.rows = array('i', order)
+        self.offsets = array('i', [0]) * (len(table.pool) + 1)
+        for row in order:
+            self.offsets[trips[row] + 1] += 1
+        for code in range(len(table.pool)):
+            self.offsets[code + 1] += self.offsets[code]
+
+    @classmethod
+    def from_arrays(cls, table: StopTimeTable, rows, offsets) -> 'TripIndex':
+        """Rebuild from previously computed arrays (e.g. a snapshot) without sorting again"""
+        index = cls.__new__(cls)
+        index.table = table
+        index.rows, index.offsets = rows, offsets
+        return index
+
+    @property
+    def nbytes(self) -> int:
+        return sum(col.itemsize * len(col) for col in (self.rows, self.offsets))
+
+    def rows_for_trip(self, trip_id: str) -> array:
+        code = self.table.pool.lookup(trip_id)
+        if code == NULL or code + 1 >= len(self.offsets):
+            return array('i')
+        return self.rows[self.offsets[code]:self.offsets[code + 1]]
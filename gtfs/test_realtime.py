@@ -0,0 +1,144 @@
+"""GTFS-Realtime trip updates against a tiny static feed and fixtures/trip_updates.pb
+
+From the repository root:
+
+    PYTHONPATH=.:gtfs python -m twisted.trial --temp-directory /tmp/_trial_temp gtfs/test_realtime.py
+
+trial writes its log to _trial_temp/ in the current directory otherwise.
+
+Regenerate the fixture with `PYTHONPATH=.:gtfs python gtfs/test_realtime.py`.
+"""
+import datetime
+import io
+import os
+
+import pytz
+from google.transit import gtfs_realtime_pb2
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+import ingest
+import models
+import realtime
+from main import GTFSResults
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "trip_updates.pb")
+TZ = pytz.timezone("America/New_York")
+SERVICE_DATE = datetime.date(2026, 6, 1)
+
+TABLES = {
+    "agency": (models.Agency,
+               "agency_id,agency_name,agency_url,agency_timezone\n"
+               "1,Test,http://example.com,America/New_York\n"),
+    "stops": (models.Stop,
+              "stop_id,stop_name,stop_lat,stop_lon\n"
+              "A,Stop A,42.30,-71.10\nB,Stop B,42.31,-71.11\nC,Stop C,42.32,-71.12\n"),
+    "routes": (models.Route,
+               "route_id,agency_id,route_short_name,route_long_name,route_type\n"
+               "1,1,1,Route 1,3\n"),
+    "trips": (models.Trip,
+              "route_id,service_id,trip_id\n"
+              "1,WKDY,T1\n1,WKDY,T2\n1,WKDY,T3\n"),
+    "stop_times": (models.StopTime,
+                   "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+                   "T1,08:00:00,08:00:00,A,1\nT1,08:05:00,08:05:00,B,2\nT1,08:10:00,08:10:00,C,3\n"
+                   "T2,09:00:00,09:00:00,A,1\nT2,09:05:00,09:05:00,B,2\n"
+                   # listed out of order on purpose, the trip index sorts by stop_sequence
+                   "T3,10:10:00,10:10:00,C,30\nT3,10:00:00,10:00:00,A,10\nT3,10:05:00,10:05:00,B,20\n"),
+}
+
+
+def load_results() -> GTFSResults:
+    tables = {}
+    for name, (parser, text) in TABLES.items():
+        tables[name] = ingest.load_table(io.StringIO(text), parser, ingest.TableStats(name=name))
+    return GTFSResults(timestamp=datetime.datetime.now(), **tables)
+
+
+def scheduled(hour: int, minute: int) -> int:
+    return int(TZ.localize(datetime.datetime.combine(SERVICE_DATE, datetime.time(hour, minute))).timestamp())
+
+
+def make_fixture() -> gtfs_realtime_pb2.FeedMessage:
+    """T1 runs 2 minutes late from its second stop, T2 is cancelled, T3 gives an absolute time at B and skips C"""
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = "2.0"
+    message.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+    message.header.timestamp = scheduled(7, 55)
+
+    entity = message.entity.add(id="1")
+    entity.trip_update.trip.trip_id = "T1"
+    update = entity.trip_update.stop_time_update.add(stop_sequence=2)
+    update.arrival.delay = 120
+
+    entity = message.entity.add(id="2")
+    entity.trip_update.trip.trip_id = "T2"
+    entity.trip_update.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.CANCELED
+
+    entity = message.entity.add(id="3")
+    entity.trip_update.trip.trip_id = "T3"
+    entity.trip_update.trip.start_date = SERVICE_DATE.strftime("%Y%m%d")
+    update = entity.trip_update.stop_time_update.add(stop_id="B")
+    update.arrival.time = scheduled(10, 5) + 300
+    update = entity.trip_update.stop_time_update.add(stop_id="C")
+    update.schedule_relationship = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+    return message
+
+
+class ResolveStopTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.results = load_results()
+
+    def test_by_sequence(self):
+        self.assertEqual(self.results.resolve_stop_time("T1", 2, None, "20260601"), (2, scheduled(8, 5)))
+
+    def test_by_stop_id(self):
+        self.assertEqual(self.results.resolve_stop_time("T3", None, "C", "20260601"), (30, scheduled(10, 10)))
+
+    def test_unknown(self):
+        self.assertIsNone(self.results.resolve_stop_time("T1", 9, None, "20260601"))
+        self.assertIsNone(self.results.resolve_stop_time("nope", 1, None, "20260601"))
+
+
+class TripUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.results = load_results()
+
+    @inlineCallbacks
+    def test_retrieve_fixture(self):
+        payload = yield realtime.retrieve_feed(FIXTURE)
+        self.assertEqual(realtime.parse_feed(payload), make_fixture())
+        missing = yield realtime.retrieve_feed(FIXTURE + ".missing")
+        self.assertIsNone(missing)
+
+    @inlineCallbacks
+    def test_apply(self):
+        payload = yield realtime.retrieve_feed("file://" + FIXTURE)
+        state = self.results.realtime
+        changed = state.apply_trip_updates(realtime.parse_feed(payload), self.results.resolve_stop_time)
+        self.assertEqual(changed, {"T1", "T2", "T3"})
+
+        # a delay holds from its stop onwards
+        self.assertEqual([state.delay_for("T1", i) for i in (1, 2, 3)], [0, 120, 120])
+        self.assertIsNone(state.delay_for("T2", 1))
+        # the absolute time became a delay, the skipped stop was resolved to its sequence
+        self.assertEqual([state.delay_for("T3", i) for i in (10, 20, 30)], [0, 300, None])
+        self.assertEqual((state.earliest, state.latest), (0, 300))
+
+    def test_full_dataset_drops_missing_trips(self):
+        state = self.results.realtime
+        state.apply_trip_updates(make_fixture(), self.results.resolve_stop_time)
+        version = state.version
+        self.assertEqual(state.apply_trip_updates(make_fixture(), self.results.resolve_stop_time), set())
+        self.assertEqual(state.version, version)
+
+        message = make_fixture()
+        del message.entity[1]
+        self.assertEqual(state.apply_trip_updates(message, self.results.resolve_stop_time), {"T2"})
+        self.assertEqual(state.delay_for("T2", 1), 0)
+
+
+if __name__ == "__main__":
+    os.makedirs(os.path.dirname(FIXTURE), exist_ok=True)
+    with open(FIXTURE, 'wb') as destination:
+        destination.write(make_fixture().SerializeToString())
@@ -0,0 +1,97 @@
+import math
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 111320.
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1., a)))
+
+
+class GridIndex:
+    """Points bucketed into square lat/lon cells of about cell_m meters, for radius and k-nearest lookups
+
+    Keys can be moved or removed one at a time, so the index can follow live data without a rebuild.
+    """
+
+    def __init__(self, cell_m: float = 250.):
+        self.cell_deg = cell_m / METERS_PER_DEGREE
+        self.cells: Dict[Tuple[int, int], Dict[Hashable, Tuple[float, float]]] = {}
+        self.points: Dict[Hashable, Tuple[float, float]] = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.points
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def insert(self, key: Hashable, lat: float, lon: float):
+        """Add a point, or move it if the key is already indexed"""
+        if key in self.points:
+            if self.points[key] == (lat, lon):
+                return
+            self.remove(key)
+        self.points[key] = (lat, lon)
+        self.cells.setdefault(self._cell(lat, lon), {})[key] = (lat, lon)
+
+    def remove(self, key: Hashable):
+        point = self.points.pop(key, None)
+        if point is None:
+            return
+        cell = self._cell(*point)
+        bucket = self.cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self.cells[cell]
+
+    def _candidates(self, lat: float, lon: float, radius_m: float):
+        dlat = radius_m / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+        lat_lo, lon_lo = self._cell(lat - dlat, lon - dlon)
+        lat_hi, lon_hi = self._cell(lat + dlat, lon + dlon)
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(self.cells):
+            # a box wider than the data, walking the occupied cells is cheaper
+            for (cell_lat, cell_lon), bucket in self.cells.items():
+                if lat_lo <= cell_lat <= lat_hi and lon_lo <= cell_lon <= lon_hi:
+                    yield from bucket.items()
+            return
+        for cell_lat in range(lat_lo, lat_hi + 1):
+            for cell_lon in range(lon_lo, lon_hi + 1):
+                bucket = self.cells.get((cell_lat, cell_lon))
+                if bucket:
+                    yield from bucket.items()
+
+    def within(self, lat: float, lon: float, radius_m: float,
+               predicate: Optional[Callable[[Any], bool]] = None) -> List[Tuple[float, Any]]:
+        """(distance in meters, key) of every point within radius_m, nearest first"""
+        found = []
+        for key, (p_lat, p_lon) in self._candidates(lat, lon, radius_m):
+            if predicate is not None and not predicate(key):
+                continue
+            distance = haversine_m(lat, lon, p_lat, p_lon)
+            if distance <= radius_m:
+                found.append((distance, key))
+        found.sort(key=lambda x: x[0])
+        return found
+
+    def nearest(self, lat: float, lon: float, k: int = 1, max_m: Optional[float] = None,
+                predicate: Optional[Callable[[Any], bool]] = None) -> List[Tuple[float, Any]]:
+        """(distance in meters, key) of the k nearest points matching predicate, growing the search radius as needed"""
+        if not self.points or k <= 0:
+            return []
+        radius = self.cell_deg * METERS_PER_DEGREE
+        limit = max_m if max_m is not None else math.pi * EARTH_RADIUS_M
+        while True:
+            radius = min(radius, limit)
+            found = self.within(lat, lon, radius, predicate)
+            if len(found) >= k or radius >= limit:
+                return found[:k]
+            radius *= 2